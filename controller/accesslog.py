@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 访问日志。按响应类的 ACCESS_LOG 属性(normal 或 quiet)对成功的请求按比例采样，
+       请求结束时只把字段记入缓冲区，由后台线程定期格式化为JSON行后写出
+@time: 2019/3/15
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from tornado.log import access_log
+
+
+class AccessLog(object):
+    FLUSH_INTERVAL = 1  # 后台线程写出的间隔秒数
+    MAX_BUFFER = 10000  # 缓冲区最多的条数，来不及写出时丢弃最早的
+    FIELDS = ['time', 'status', 'method', 'uri', 'ms', 'ip', 'user', 'handler', 'sample']
+
+    def __init__(self, filename=None, sample=None):
+        self.filename = filename
+        self.sample = dict(normal=1, quiet=0.01)
+        self.sample.update(sample or {})
+        self.rates = {}  # 响应类: 采样比例
+        self.buffer = deque(maxlen=self.MAX_BUFFER)
+        self.event = threading.Event()
+        self.thread = self.file = None
+        self.pid = None
+
+    def get_rate(self, cls):
+        rate = self.rates.get(cls)
+        if rate is None:
+            rate = self.rates[cls] = float(self.sample.get(getattr(cls, 'ACCESS_LOG', 'normal'), 1.0))
+        return rate
+
+    def log(self, handler):
+        """ 记录一个已结束的请求，出错的请求都记录，成功的和404请求按响应类的比例采样 """
+        status = handler.get_status()
+        rate = 1.0
+        if status < 400 or status == 404:
+            rate = self.get_rate(type(handler)) if status != 404 else self.sample['quiet']
+            if rate < 1 and random.random() >= rate:
+                return
+        request, user = handler.request, getattr(handler, '_current_user', None)
+        user = user and (getattr(user, 'name', None) or isinstance(user, dict) and user.get('name')) or None
+        self.buffer.append((time.time(), status, request.method, request.uri,
+                            round(1000.0 * request.request_time(), 2), request.remote_ip, user,
+                            type(handler).__name__, rate))
+        if self.pid != os.getpid():
+            self.start()
+
+    def start(self):
+        """ 在本进程中启动写出线程，派生工作进程后各自启动 """
+        self.pid = os.getpid()
+        self.file = self.filename and open(self.filename, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.event.wait(self.FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        lines = []
+        while self.buffer:
+            item = dict(zip(self.FIELDS, self.buffer.popleft()))
+            item['time'] = datetime.fromtimestamp(item['time']).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+            if item['user'] is None:
+                item.pop('user')
+            lines.append((item['status'], json.dumps(item, ensure_ascii=False)))
+        if not lines:
+            return
+        if self.file:
+            self.file.write(''.join(line + '\n' for _, line in lines))
+            self.file.flush()
+        else:
+            for status, line in lines:
+                level = logging.INFO if status < 400 else logging.WARNING if status < 500 else logging.ERROR
+                access_log.log(level, line)
+
+    def close(self):
+        if self.thread and self.pid == os.getpid():
+            self.event.set()
+            self.thread.join(5)
+        elif self.buffer:
+            self.flush()
+        if self.file:
+            self.file.close()
+        self.thread = self.file = self.pid = None
+        self.event.clear()
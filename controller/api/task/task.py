@@ -6,9 +6,13 @@
 
 from controller.base import BaseHandler, DbError, convert_bson
 from datetime import datetime
+from tornado.escape import json_decode, json_encode
+import hashlib
 
 import model.user as u
+from model.box import check_boxes, box_parents, merge_boxes
 from controller import errors
+from controller.periodic import create_task_indexes
 import re
 from functools import cmp_to_key
 
@@ -20,14 +24,38 @@ class GetPageApi(BaseHandler):
     def get(self, name):
         """ 获取页面数据 """
         try:
-            page = self.db.page.find_one(dict(name=name))
+            page = self.db.page.find_one(dict(name=name), {'version': 1})
             if not page:
                 return self.send_error(errors.no_object)
+            if self.check_etag('%s-%d' % (page['_id'], page.get('version', 0))):
+                return
+            page = self.db.page.find_one(dict(name=name))
             self.send_response(convert_bson(page))
         except DbError as e:
             self.send_db_error(e)
 
 
+class GetPageBoxesApi(BaseHandler):
+    URL = r'/api/page/([A-Za-z0-9_]+)/(block|column|char)s'
+    AUTHORITY = 'testing', 'any'
+
+    def get(self, name, box_type):
+        """ 获取页面的一种切分框数据，地址带有当前版本号(v参数)时可长期缓存 """
+        try:
+            field = box_type + 's'
+            page = self.db.page.find_one(dict(name=name), {'version': 1})
+            if not page:
+                return self.send_error(errors.no_object)
+            version = page.get('version', 0)
+            max_age = 3600 * 24 * 365 if self.get_query_argument('v', None) == str(version) else 0
+            if self.check_etag('%s-%d-%s' % (page['_id'], version, box_type), max_age):
+                return
+            page = self.db.page.find_one(dict(name=name), {field: 1})
+            self.send_response(dict(name=name, version=version, boxes=page.get(field, [])))
+        except DbError as e:
+            self.send_db_error(e)
+
+
 class GetPagesApi(BaseHandler):
     URL = r'/api/pages/([a-z_]+)'
     AUTHORITY = 'testing', u.ACCESS_TASK_MGR
@@ -54,21 +82,61 @@ class GetPagesApi(BaseHandler):
                 task_types = [t for t in (data.types or '').split(',') if t in all_types]
                 task_types = task_types or all_types
 
-                pages = self.db.page.find({'$or': [{t + '_status': None} for t in task_types]})
+                pages = self.db.page.find({'$or': [{t + '_status': None} for t in task_types]}, {'name': 1})
                 self.send_response([p['name'] for p in pages])
             else:
-                pages = [convert_bson(p) for p in self.db.page.find({})
-                         if [t for t in all_types if p.get(t + '_status')]]
-                for p in pages:
-                    for field, value in list(p.items()):
-                        if field == 'txt':
-                            p[field] = len(p[field])
-                        elif isinstance(value, list):
-                            del p[field]
-                self.send_response(pages)
+                pages = self.get_status_pages(all_types)
+                if pages is not None:
+                    self.send_response(pages)
         except DbError as e:
             self.send_db_error(e)
 
+    def get_status_pages(self, all_types):
+        """ 按藏别和册别聚合各任务类型的状态页数，并分页取已发布任务的页面状态 """
+        prefix = self.get_query_argument('prefix', '')
+        try:
+            page_no = max(1, int(self.get_query_argument('page', 1)))
+            page_size = min(max(1, int(self.get_query_argument('page_size', 50))), 1000)
+        except ValueError:
+            return self.send_error(errors.invalid_parameter)
+        if not re.match(r'^[A-Za-z0-9_]*$', prefix):
+            return self.send_error(errors.invalid_parameter)
+
+        create_task_indexes(self.db)
+        name_cond = {'name': re.compile('^' + prefix)} if prefix else {}
+        cond = dict(name_cond, **{'$or': [{t + '_status': {'$ne': None}} for t in all_types]})
+
+        # 页面有改变时其版本号会增加，所以由页数和版本号之和可判断列表是否改变，只需扫描页名和版本号的索引
+        changed = list(self.db.page.aggregate([{'$match': name_cond}, {'$group': {
+            '_id': None, 'count': {'$sum': 1}, 'version': {'$sum': '$version'}}}], hint='name_1_version_1'))
+        changed = changed and [changed[0]['count'], changed[0]['version']]
+        tag = hashlib.md5(json_encode([all_types, prefix, page_no, page_size, changed]).encode()).hexdigest()
+        if self.check_etag(tag):
+            return
+
+        # 各藏别、各册(页名的前两段)、各任务类型的状态直方图，未发布的状态记为none
+        stats, total = {}, 0
+        parts = {'$split': ['$name', '_']}
+        volume = {'$concat': [{'$arrayElemAt': [parts, 0]}, '_', {'$ifNull': [{'$arrayElemAt': [parts, 1]}, '']}]}
+        group = dict(kind='$kind', volume=volume, **{t: '$' + t + '_status' for t in all_types})
+        for r in self.db.page.aggregate([{'$match': cond}, {'$group': {'_id': group, 'count': {'$sum': 1}}}]):
+            kind_stats = stats.setdefault(r['_id'].get('kind') or '', {})
+            volume_stats = kind_stats.setdefault(r['_id'].get('volume') or '', {})
+            for t in all_types:
+                counts = volume_stats.setdefault(t, {})
+                status = r['_id'].get(t) or 'none'
+                counts[status] = counts.get(status, 0) + r['count']
+            total += r['count']
+
+        # 当前页的页面，只取状态字段和文本长度，不取切分框数据
+        fields = dict(name=1, kind=1, txt={'$strLenCP': {'$ifNull': ['$txt', '']}})
+        fields.update({t + f: 1 for t in all_types for f in ['_status', '_priority', '_nickname']})
+        pages = self.db.page.aggregate([{'$match': cond}, {'$sort': {'name': 1}},
+                                        {'$skip': (page_no - 1) * page_size}, {'$limit': page_size},
+                                        {'$project': fields}])
+        return dict(items=[convert_bson(p) for p in pages], stats=stats,
+                    total=total, page_no=page_no, page_size=page_size, prefix=prefix)
+
 
 class UnlockTasksApi(BaseHandler):
     URL = r'/api/unlock/(%s)/([A-Za-z0-9_]*)', u.re_task_type + '|cut_proof|cut_review|cut|text'
@@ -86,7 +154,7 @@ class UnlockTasksApi(BaseHandler):
                         info[field] = None
                 if info:
                     name = page['name']
-                    r = self.db.page.update_one(dict(name=name), {'$unset': info})
+                    r = self.db.page.update_one(dict(name=name), {'$unset': info, '$inc': {'version': 1}})
                     if r.modified_count:
                         self.add_op_log('unlock_' + task_type, file_id=str(page['_id']), context=name)
                         ret.append(name)
@@ -128,7 +196,7 @@ class StartTasksApi(BaseHandler):
                     # 是第一轮任务就为待领取，否则要等前一轮完成才能继续
                     status = u.STATUS_PENDING if i or self.has_pre_task(page, task_type) else u.STATUS_OPENED
                     new_value = {task_status: status, task_type + '_priority': data.priority}
-                    r = self.db.page.update_one(dict(name=name), {'$set': new_value})
+                    r = self.db.page.update_one(dict(name=name), {'$set': new_value, '$inc': {'version': 1}})
                     if r.modified_count:
                         self.add_op_log('start_' + task_type, file_id=str(page['_id']), context=name)
                         names.add(name)
@@ -171,7 +239,7 @@ class PickTaskApi(BaseHandler):
                 task_status: u.STATUS_LOCKED,
                 task_type + '_start_time': datetime.now()
             }
-            r = self.db.page.update_one(can_lock, {'$set': lock})
+            r = self.db.page.update_one(can_lock, {'$set': lock, '$inc': {'version': 1}})
             page = convert_bson(self.db.page.find_one(dict(name=name)))
 
             if r.matched_count:
@@ -228,6 +296,7 @@ class PickTextReviewTaskApi(PickTaskApi):
 class SaveTask(object):
     name = str
     submit = int
+    boxes = str  # 切分框列表的JSON串，为空则不改变切分框
 
 
 class SaveCutApi(BaseHandler):
@@ -250,6 +319,8 @@ class SaveCutApi(BaseHandler):
                 return self.send_error(errors.task_locked)
 
             result = dict(name=data.name)
+            if data.boxes and not self.save_boxes(result, data, page, task_type, task_user):
+                return
             if data.submit:
                 self.submit_task(result, data, page, task_type, task_user)
 
@@ -257,12 +328,46 @@ class SaveCutApi(BaseHandler):
         except DbError as e:
             self.send_db_error(e)
 
+    def save_boxes(self, result, data, page, task_type, task_user):
+        """ 检查并保存切分框，有无效或越界的框时不保存，重叠或不在上级框内的框在 result['problems'] 中返回 """
+        box_type = task_type.split('_')[0] + 's'
+        try:
+            boxes = json_decode(data.boxes)
+        except ValueError:
+            return self.send_error(errors.invalid_parameter)
+        if not isinstance(boxes, list) or not all(isinstance(b, dict) for b in boxes):
+            return self.send_error(errors.invalid_parameter)
+        boxes = merge_boxes(box_type, boxes, page.get(box_type))
+        parent = box_parents.get(box_type)
+        problems = check_boxes(page['width'], page['height'], **dict(
+            [(box_type, boxes)] + ([(parent, page.get(parent) or [])] if parent else [])))
+        problems = [p for p in problems if p['type'] == box_type]
+        fatal = [p for p in problems if p['fatal']]
+        if fatal:
+            return self.send_error(errors.invalid_box, reason=', '.join(
+                '%s(%s)' % (p['error'], p['id'] or p['index'] + 1) for p in fatal[:5]))
+
+        r = self.db.page.update_one(self.locked_cond(data, task_type, task_user),
+                                    {'$set': {box_type: boxes}, '$inc': {'version': 1}})
+        if not r.matched_count:  # 读取页面后任务已提交或被收回
+            return self.send_error(errors.task_changed)
+        result['saved'] = True
+        result['problems'] = problems
+        return True
+
+    def locked_cond(self, data, task_type, task_user):
+        """ 当前用户仍锁定着此任务的页面条件 """
+        return {'name': data.name, task_user: self.current_user.id, task_type + '_status': u.STATUS_LOCKED}
+
     def submit_task(self, result, data, page, task_type, task_user):
         end_info = {task_type + '_status': u.STATUS_ENDED, task_type + '_end_time': datetime.now()}
-        r = self.db.page.update_one({'name': data.name, task_user: self.current_user.id}, {'$set': end_info})
+        r = self.db.page.update_one(self.locked_cond(data, task_type, task_user),
+                                    {'$set': end_info, '$inc': {'version': 1}})
         if r.modified_count:
             result['submit'] = True
             self.add_op_log('submit_' + task_type, file_id=page['id'], context=data.name)
+            self.db.user_stat.update_one({'_id': self.current_user.id},
+                                         {'$inc': {task_type: 1, u.stat_of_task[task_type]: 1}}, upsert=True)
 
             idx = u.task_types.index(task_type)
             for i in range(idx + 1, len(u.task_types)):
@@ -270,7 +375,7 @@ class SaveCutApi(BaseHandler):
                 status = page.get(next_status)
                 if status:
                     r = self.db.page.update_one({'name': data.name, next_status: u.STATUS_PENDING},
-                                                {'$set': {next_status: u.STATUS_OPENED}})
+                                                {'$set': {next_status: u.STATUS_OPENED}, '$inc': {'version': 1}})
                     if r.modified_count:
                         self.add_op_log('resume_' + task_type, file_id=page['id'], context=data.name)
                         result['resume_next'] = True
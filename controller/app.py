@@ -6,16 +6,27 @@
 """
 
 from os import path
-from tornado import web
+from tornado import gen, httputil, template, web
 from tornado.options import define, options
 from tornado.util import PY3
 import pymongo
 import yaml
 from operator import itemgetter
+import gc
+import logging
 import os
-import re
 import shutil
-from tornado.log import access_log
+import time
+from PIL import Image
+from controller.page_codes import PageCodeIndex
+from controller.fragment import TemplateLoader
+from controller.image import ImageHandler, TileHandler
+from controller.metrics import Metrics, MetricsHandler
+from controller.accesslog import AccessLog
+from controller.profiler import Profiler, ProfilesHandler
+from controller.dbmonitor import DbMonitor, QueriesHandler
+from controller import logframe
+from controller.periodic import Scheduler
 
 
 __version__ = '0.0.6.90307'
@@ -26,20 +37,82 @@ define('debug', default=True, help='the debug mode', type=bool)
 define('port', default=8000, help='run port', type=int)
 
 
+class StaticHandler(web.StaticFileHandler):
+    """ 静态文件响应类，由 views/static.py build 生成的带内容哈希的合并文件可永久缓存 """
+    ACCESS_LOG = 'quiet'
+
+    @staticmethod
+    def is_bundle(rel_path):
+        return rel_path.startswith('dist/bundle.')
+
+    def get_cache_time(self, rel_path, modified, mime_type):
+        if self.is_bundle(rel_path):
+            return self.CACHE_MAX_AGE
+        return super(StaticHandler, self).get_cache_time(rel_path, modified, mime_type)
+
+    def set_extra_headers(self, rel_path):
+        if self.is_bundle(rel_path):
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % self.CACHE_MAX_AGE)
+
+
+class RequestDelegate(httputil.HTTPMessageDelegate):
+    """ 转发请求的各个事件，读取请求体时连接中断则结束计数 """
+
+    def __init__(self, application, request, delegate):
+        self.application = application
+        self.request = request
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        self.application.request_done(self.request)
+        return self.delegate.on_connection_close()
+
+
 class Application(web.Application):
+    DRAIN_TIMEOUT = 30  # 停止服务时等待正在处理的请求完成的最长秒数
+
     def __init__(self, handlers, **settings):
         self._db = self.config = self.site = None
         self.channels = {}
+        self.requests = 0  # 正在处理的请求数
         self.load_config(settings.get('db_name_ext'))
+        logframe.install(self.config.get('log_caller', True))
 
         self.IMAGE_PATH = path.join(BASE_DIR, 'static', 'img')
         if not path.exists(self.IMAGE_PATH):
             os.mkdir(self.IMAGE_PATH)
+        self.page_codes = PageCodeIndex(path.join(BASE_DIR, 'page_codes.idx'), path.join(BASE_DIR, 'page_codes.json'))
+        self.metrics = Metrics(path.join(BASE_DIR, 'cache', 'metrics'))
+        self.scheduler = Scheduler(self)
+        log_cfg = self.config.get('access_log') or {}
+        self.access_log = AccessLog(log_cfg.get('file'), log_cfg.get('sample'))
+        db_cfg = self.config.get('db_monitor') or {}
+        self.db_monitor = DbMonitor(db_cfg.get('slow_ms', 100), db_cfg.get('explain', True))
+        prof_cfg = self.config.get('profile') or {}
+        self.profiler = Profiler(path.join(BASE_DIR, 'cache', 'profile'), prof_cfg.get('threshold_ms'),
+                                 prof_cfg.get('sample'), prof_cfg.get('interval_ms', 5), prof_cfg.get('keep', 200))
 
         self.version = __version__
         self.BASE_DIR = BASE_DIR
         self.handlers = handlers
-        handlers = [(r'/php/(\w+/\w+\.(png|jpg|jpeg|gif|bmp))', web.StaticFileHandler, dict(path=self.IMAGE_PATH))]
+        handlers = [(r'/php/(\w+/\w+\.(png|jpg|jpeg|gif|bmp))', StaticHandler, dict(path=self.IMAGE_PATH)),
+                    (ImageHandler.URL, ImageHandler, dict(
+                        path=self.IMAGE_PATH, cache_path=path.join(BASE_DIR, 'cache', 'thumb'),
+                        cache_size=self.config.get('image_cache_mb', 1024) * 1024 * 1024)),
+                    (MetricsHandler.URL, MetricsHandler), (QueriesHandler.URL, QueriesHandler)]
+        handlers.extend((url, TileHandler, dict(
+            path=self.IMAGE_PATH, tile_path=path.join(BASE_DIR, 'cache', 'tiles'),
+            cache_size=self.config.get('tile_cache_mb', 4096) * 1024 * 1024)) for url in TileHandler.URL)
+        handlers.extend((url, ProfilesHandler) for url in ProfilesHandler.URL)
 
         for cls in self.handlers:
             if isinstance(cls.URL, list):
@@ -51,29 +124,35 @@ class Application(web.Application):
         handlers = sorted(handlers, key=itemgetter(0))
         web.Application.__init__(self, handlers, debug=options.debug,
                                  login_url='/login',
-                                 compiled_template_cache=False,
+                                 compress_response=True,
+                                 compiled_template_cache=not options.debug,
                                  static_path=path.join(BASE_DIR, 'static'),
+                                 static_handler_class=StaticHandler,
                                  template_path=path.join(BASE_DIR, 'views'),
+                                 template_loader=TemplateLoader(path.join(BASE_DIR, 'views')),
                                  cookie_secret=self.config['cookie_secret'],
                                  log_function=self.log_function,
                                  **settings)
 
+    def get_handler_delegate(self, request, target_class, target_kwargs=None, path_args=None, path_kwargs=None):
+        self.requests += 1  # 收到请求头后才计数，空闲的长连接不计在内
+        request.counted = True
+        return RequestDelegate(self, request, super(Application, self).get_handler_delegate(
+            request, target_class, target_kwargs, path_args, path_kwargs))
+
+    def request_done(self, request):
+        """ 请求结束或连接中断时减少计数，每个请求只减一次 """
+        if getattr(request, 'counted', False):
+            request.counted = False
+            self.requests -= 1
+
+    def log_request(self, handler):
+        self.request_done(handler.request)
+        self.metrics.observe(handler, handler.request.request_time())
+        super(Application, self).log_request(handler)
+
     def log_function(self, handler):
-        summary = handler._request_summary()
-        if not(handler.get_status() in [304, 200] and re.search(r'GET /(static|api/(pull|message|discuss))', summary)
-               or handler.get_status() == 404):
-            nickname = hasattr(handler, 'current_user') and handler.current_user
-            nickname = nickname and (hasattr(nickname, 'name') and nickname.name or nickname.get('name')) or ''
-            request_time = 1000.0 * handler.request.request_time()
-
-            if handler.get_status() < 400:
-                log_method = access_log.info
-            elif handler.get_status() < 500:
-                log_method = access_log.warning
-            else:
-                log_method = access_log.error
-            log_method("%d %s %.2fms%s", handler.get_status(),
-                       summary, request_time, nickname and ' [%s]' % nickname or '')
+        self.access_log.log(handler)
 
     @property
     def db(self):
@@ -84,8 +163,8 @@ class Application(web.Application):
                 uri = 'mongodb://{0}:{1}@{2}:{3}/admin'.format(
                     cfg.get('user'), cfg.get('password'), cfg.get('host'), cfg.get('port'))
             conn = pymongo.MongoClient(uri, connectTimeoutMS=2000, serverSelectionTimeoutMS=2000,
-                                       maxPoolSize=10, waitQueueTimeoutMS=5000)
-            self._db = conn[cfg['name']]
+                                       maxPoolSize=10, waitQueueTimeoutMS=5000, event_listeners=[self.db_monitor])
+            self._db = self.db_monitor.db = conn[cfg['name']]
         return self._db
 
     def load_config(self, db_name_ext=None):
@@ -100,5 +179,36 @@ class Application(web.Application):
             if db_name_ext and not self.config['database']['name'].endswith('_test'):
                 self.config['database']['name'] += db_name_ext
 
-    def stop(self):
-        pass
+    def preload(self):
+        """ 在派生工作进程前加载只读的数据，冻结已有对象不再被垃圾回收扫描，以便各工作进程按写时复制共享这些内存 """
+        loader = self.settings['template_loader']
+        for fn in sorted(os.listdir(loader.root)):
+            if fn.endswith('.html'):
+                try:
+                    loader.load(fn)
+                except (template.ParseError, IOError) as e:
+                    logging.warning('preload template %s: %s' % (fn, str(e)))
+        Image.preinit()
+        Image.init()
+        len(self.page_codes)
+        if hasattr(gc, 'freeze'):  # Python 3.7+
+            gc.collect()
+            gc.freeze()
+
+    @gen.coroutine
+    def stop(self, server=None, timeout=DRAIN_TIMEOUT):
+        """ 停止服务。指定了 server 时先停止接受连接，等待正在处理的请求完成(最多 timeout 秒)，再释放资源 """
+        if server:
+            server.stop()
+            deadline = time.time() + timeout
+            while self.requests and time.time() < deadline:
+                yield gen.sleep(0.1)
+            if self.requests:
+                logging.warning('%d requests not finished in %ds' % (self.requests, timeout))
+        self.scheduler.stop()
+        if self.metrics.data:  # 写出最后的计数，进程退出后由 collect 并入 retired.json
+            self.metrics.save()
+        self.page_codes.close()
+        self.access_log.close()
+        self.profiler.stop()
+        self.db_monitor.close()
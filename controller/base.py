@@ -21,22 +21,12 @@ from tornado_cors import CorsMixin
 from tornado import gen
 from tornado.httpclient import AsyncHTTPClient
 
-from controller import errors
+from controller import errors, logframe
+from controller.fragment import fragment_cache
 from model.user import User, authority_map, ACCESS_ALL
 
 
-def my_framer():
-    f0 = f = old_framer()
-    if f is not None:
-        f = f.f_back
-        while re.search(r'(web|base)\.py|logging', f.f_code.co_filename):
-            f0 = f
-            f = f.f_back
-    return f0
-
-
-old_framer = logging.currentframe
-logging.currentframe = my_framer
+logframe.install()
 
 MongoError = (PyMongoError, BSONError)
 DbError = MongoError
@@ -86,6 +76,9 @@ class BaseHandler(CorsMixin, RequestHandler):
     """ 后端API响应类的基类 """
     CORS_HEADERS = 'Content-Type,Host,X-Forwarded-For,X-Requested-With,User-Agent,Cache-Control,Cookies,Set-Cookie'
     CORS_CREDENTIALS = True
+    internal = False  # 为True时由 call_api 在进程内调用，响应内容记在 internal_result 而不输出
+    parent = None  # 由 call_api 调用时为发起调用的响应对象，文档库耗时和采样都计入它
+    ACCESS_LOG = 'normal'  # 访问日志的类别，轮询等频繁请求的响应类可设为 quiet，成功的请求按配置的比例采样记录
 
     def set_default_headers(self):
         self.set_header('Access-Control-Allow-Origin', '*' if options.debug else self.application.site['domain'])
@@ -100,6 +93,8 @@ class BaseHandler(CorsMixin, RequestHandler):
         self.db = self.application.db
 
     def prepare(self):
+        if self.application.profiler.enabled and not self.internal:  # 内部调用不会结束，采样计入发起者
+            self.application.profiler.start(self)
         if hasattr(self, 'AUTHORITY'):
             auths = list(self.AUTHORITY) if isinstance(self.AUTHORITY, tuple) else [self.AUTHORITY]
             if 'testing' in auths and options.testing:
@@ -111,6 +106,21 @@ class BaseHandler(CorsMixin, RequestHandler):
             if not [r for r in auths if r in self.authority]:
                 return self.send_error(errors.unauthorized, reason='|'.join(auths))
 
+    def finish(self, chunk=None):
+        if not self._headers_written:  # 文档库命令的次数和耗时，由 DbMonitor 累计
+            self.set_header('Server-Timing', 'db;dur=%.1f;desc="%d commands", total;dur=%.1f' % (
+                getattr(self, 'db_time', 0) * 1000, getattr(self, 'db_count', 0),
+                self.request.request_time() * 1000))
+        return super(BaseHandler, self).finish(chunk)
+
+    def on_finish(self):
+        if self.application.profiler.enabled:
+            self.application.profiler.finish(self)
+
+    def on_connection_close(self):
+        self.application.request_done(self.request)  # 客户端已断开，停止服务时不再等待本请求
+        super(BaseHandler, self).on_connection_close()
+
     def get_current_user(self):
         if 'Access-Control-Allow-Origin' not in self._headers:
             self.write({'code': 403, 'error': 'Forbidden'})
@@ -160,6 +170,19 @@ class BaseHandler(CorsMixin, RequestHandler):
             return self.send_response(kwargs)
         super(BaseHandler, self).render(template_name, dumps=lambda p: json_encode(p), **kwargs)
 
+    def render_fragment(self, template_name, **kwargs):
+        """
+        渲染可缓存的网页片段，模板名和变量值都相同时取自缓存
+        :param template_name: 片段模板，其输出只能依赖于 kwargs 中的变量
+        :param kwargs: 传给模板的变量，其值须可哈希，作为缓存键
+        """
+        key = (template_name,) + tuple(sorted(kwargs.items()))
+        html = fragment_cache.get(key)
+        if html is None:
+            html = self.render_string(template_name, **kwargs)
+            fragment_cache.set(key, html)
+        return html
+
     @staticmethod
     def _trim_obj(obj, param_type):
         if param_type not in [dict, str, int, float]:
@@ -242,13 +265,33 @@ class BaseHandler(CorsMixin, RequestHandler):
 
     def send_response(self, response=None, trim=None):
         """ 发送并结束API响应内容 """
-        self.set_header('Content-Type', 'application/json; charset=UTF-8')
         response = self.convert_for_send({'code': 200} if response is None else response, trim)
+        if self.internal:
+            self.internal_result = {'items': response} if isinstance(response, list) else response
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
         if not isinstance(response, dict):
             response = json_encode({'items': response} if isinstance(response, list) else response)
         self.write(response)
         self.finish()
 
+    def check_etag(self, tag, max_age=0):
+        """
+        设置强ETag，如果与客户端缓存的一致则直接回复304而不再取数据和序列化
+        :param tag: 由版本号等可判断内容是否改变的值构成的字符串
+        :param max_age: 客户端可不经验证而直接使用缓存的秒数，用于带版本号的地址
+        :return: 是否已回复304
+        """
+        if self.internal or self.request.method != 'GET':
+            return False
+        self.set_header('Etag', '"%s"' % tag)
+        self.set_header('Cache-Control', 'private, max-age=%d, immutable' % max_age if max_age else 'private, no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
     def send_error(self, status_code=500, **kwargs):
         """ 发送并结束API异常响应消息 """
         if isinstance(status_code, tuple):
@@ -263,6 +306,9 @@ class BaseHandler(CorsMixin, RequestHandler):
     def write_error(self, status_code, **kwargs):
         reason = kwargs.get('reason') or self._reason
         reason = reason if reason != 'OK' else '无权访问' if status_code == 403 else '后台服务出错'
+        if self.internal:
+            self.internal_result = {'code': status_code, 'error': reason}
+            return
         logging.error('%d %s [%s %s]' % (status_code, reason,
                                          self.current_user and self.current_user.name, self.get_ip()))
         if not self._finished:
@@ -328,6 +374,30 @@ class BaseHandler(CorsMixin, RequestHandler):
                                     create_time=errors.get_date_time(),
                                     ip=self.get_ip()))
 
+    def call_api(self, api_cls, *args, **kwargs):
+        """
+        在当前请求内直接调用API响应类，沿用当前请求的用户和权限，不经HTTP回环和JSON编解码
+        :param api_cls: API响应类，例如 GetPagesApi
+        :param args: URL 匹配出的参数
+        :param kwargs: method 为响应方法名，默认为 get
+        :return: 与HTTP响应解码后相同的内容(dict)，出错时为含 code 和 error 的 dict
+        """
+        api = api_cls(self.application, self.request)
+        if self.request.connection:
+            self.request.connection.set_close_callback(self.on_connection_close)
+        api.internal = True
+        api.parent = self
+        api.internal_result = None
+        api.current_user = self.current_user
+        api.authority = self.authority
+        try:
+            api.prepare()
+            if api.internal_result is None:
+                getattr(api, kwargs.get('method', 'get'))(*args)
+        except Warning as e:
+            api.internal_result = api.internal_result or {'code': errors.auth_changed[0], 'error': e.args[-1]}
+        return api.internal_result or {'code': 200}
+
     @gen.coroutine
     def call_back_api(self, url, handle_response, handle_error=None, **kwargs):
         self._auto_finish = False
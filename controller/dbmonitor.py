@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 文档库命令监视。记录每个命令的耗时并计入发出该命令的响应对象(调用栈中的 RequestHandler)，
+       超过 slow_ms 的命令在后台线程中用 explain 取得查询计划，记入慢查询日志和最近的慢查询列表(/debug/queries)
+@time: 2019/3/17
+"""
+
+import json
+import logging
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+from tornado import web
+from tornado.options import options
+
+from controller.metrics import metrics_allowed
+
+slow_log = logging.getLogger('dzj.slow_query')
+
+EXPLAIN_COMMANDS = {'find', 'count', 'distinct', 'aggregate', 'update', 'delete', 'findAndModify'}
+COMMAND_FIELDS = {'$db', '$readPreference', '$clusterTime', 'lsid', 'txnNumber', 'cursor', 'batchSize', 'writeConcern'}
+
+
+def query_shape(value):
+    """ 查询条件的形状，只保留字段名和操作符，各个值替换为1，便于合并同类查询 """
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], dict):
+        return [query_shape(v) for v in value]
+    return 1
+
+
+def get_filter(name, cmd):
+    if name in ('update', 'delete'):
+        items = cmd.get(name + 's') or [{}]
+        return items[0].get('q')
+    if name == 'aggregate':
+        match = [s['$match'] for s in cmd.get('pipeline', []) if '$match' in s]
+        return match[0] if match else None
+    return cmd.get('filter', cmd.get('query'))
+
+
+def plan_summary(explain):
+    """ 由 explain 的结果得到查询计划的摘要，例如 FETCH>IXSCAN(name_1)、COLLSCAN """
+    planner = explain.get('queryPlanner')
+    if not planner and explain.get('stages'):  # aggregate
+        planner = explain['stages'][0].get('$cursor', {}).get('queryPlanner')
+    plan, stages = (planner or {}).get('winningPlan'), []
+    while plan:
+        stage = plan.get('stage', '?')
+        stages.append('%s(%s)' % (stage, plan['indexName']) if plan.get('indexName') else stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return '>'.join(stages) or None
+
+
+_handler_codes = {}  # 代码对象: 是否为响应类的方法，跳过 pymongo 等其他类的方法
+
+
+def find_handler():
+    """ 在调用栈中查找发出命令的响应对象，call_api 内部调用的响应对象换为发起调用者 """
+    f = sys._getframe(2)
+    while f is not None:
+        code = f.f_code
+        is_handler = _handler_codes.get(code)
+        if is_handler is not False and code.co_argcount and code.co_varnames[0] == 'self':
+            obj = f.f_locals.get('self')
+            is_handler = _handler_codes[code] = isinstance(obj, web.RequestHandler)
+            if is_handler:
+                while getattr(obj, 'parent', None) is not None:
+                    obj = obj.parent
+                return obj
+        f = f.f_back
+
+
+class DbMonitor(monitoring.CommandListener):
+    MAX_SLOW = 200  # 保留最近的慢查询条数
+    EXPLAIN_TTL = 600  # 同形状的查询在此秒数内只 explain 一次
+    MAX_PLANS = 1000
+
+    def __init__(self, slow_ms=100, explain=True):
+        self.slow = (slow_ms or 0) / 1000.0
+        self.explain = explain
+        self.db = None  # 由 Application.db 设置，用于 explain
+        self.running = {}  # (连接, 请求号): (响应对象, 命令名, 集合名, 命令)
+        self.recent = deque(maxlen=self.MAX_SLOW)
+        self.plans = {}  # 查询形状: (explain 时间, 计划摘要)
+        self.executor = None
+
+    def started(self, event):
+        name = event.command_name
+        if name in ('explain', 'isMaster', 'ping', 'endSessions'):
+            return
+        cmd = event.command
+        collection = cmd.get(name) if isinstance(cmd.get(name), str) else cmd.get('collection')
+        self.running[event.connection_id, event.request_id] = (find_handler(), name, collection, cmd)
+
+    def succeeded(self, event):
+        self.finished(event, None)
+
+    def failed(self, event):
+        self.finished(event, event.failure)
+
+    def finished(self, event, failure):
+        item = self.running.pop((event.connection_id, event.request_id), None)
+        if item is None:
+            return
+        handler, name, collection, cmd = item
+        seconds = event.duration_micros / 1e6
+        if handler is not None:
+            handler.db_time = getattr(handler, 'db_time', 0) + seconds
+            handler.db_count = getattr(handler, 'db_count', 0) + 1
+        if self.slow and seconds >= self.slow:
+            self.log_slow(handler, name, collection, cmd, seconds, failure)
+
+    def log_slow(self, handler, name, collection, cmd, seconds, failure):
+        request = handler and handler.request
+        shape = query_shape(get_filter(name, cmd))
+        entry = dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), ms=round(seconds * 1000, 1),
+                     op=name, collection=collection, filter=shape,
+                     handler=type(handler).__name__ if handler else None,
+                     route=request and '%s %s' % (request.method, request.path))
+        if failure:
+            entry['error'] = str(failure.get('errmsg', failure) if isinstance(failure, dict) else failure)[:200]
+        key = json.dumps([name, collection, shape], sort_keys=True)
+        cached = self.plans.get(key)
+        if cached and time.time() - cached[0] < self.EXPLAIN_TTL:
+            entry['plan'] = cached[1]
+            self.add_slow(entry)
+        elif self.explain and self.db is not None and name in EXPLAIN_COMMANDS:
+            if len(self.plans) > self.MAX_PLANS:
+                self.plans.clear()
+            self.plans[key] = (time.time(), None)
+            if not self.executor:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.executor.submit(self.explain_slow, entry, key, cmd)
+        else:
+            self.add_slow(entry)
+
+    def explain_slow(self, entry, key, cmd):
+        """ 在后台线程中取得查询计划后再记录慢查询 """
+        cmd = {k: v for k, v in cmd.items() if k not in COMMAND_FIELDS}
+        for k in ('updates', 'deletes'):
+            if k in cmd:
+                cmd[k] = cmd[k][:1]
+        if entry['op'] == 'aggregate':
+            cmd['cursor'] = {}
+        try:
+            entry['plan'] = plan_summary(self.db.command('explain', cmd, verbosity='queryPlanner'))
+            self.plans[key] = (time.time(), entry['plan'])
+        except PyMongoError as e:
+            entry['plan'] = 'explain failed: %s' % str(e)[:100]
+        self.add_slow(entry)
+
+    def add_slow(self, entry):
+        self.recent.append(entry)
+        slow_log.warning(json.dumps(entry, ensure_ascii=False, default=str))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class QueriesHandler(web.RequestHandler):
+    """ 最近的慢查询: /debug/queries，按耗时降序。调试模式或 metrics_allow 中的地址可访问 """
+    ACCESS_LOG = 'quiet'
+    URL = r'/debug/queries'
+
+    def get(self):
+        if not options.debug and not metrics_allowed(self):
+            raise web.HTTPError(403)
+        self.set_header('Cache-Control', 'no-cache')
+        try:
+            count = int(self.get_query_argument('count', 50))
+        except ValueError:
+            raise web.HTTPError(400, 'invalid count')
+        monitor = self.application.db_monitor
+        items = sorted(monitor.recent, key=lambda a: -a['ms'])[:max(1, count)]
+        self.write(dict(slow_ms=monitor.slow * 1000, items=items))
@@ -28,6 +28,7 @@ no_object = 1014, '对象不存在或已删除'
 task_locked = 2000, '本任务已被领走，请领取新的任务'
 task_uncompleted = 2001, '您还有未完成的任务，请继续完成后再领取新的任务'
 task_changed = 2002, '本任务的状态已改变'
+invalid_box = 2003, '切分框无效'
 
 
 def get_date_time(fmt=None, diff_seconds=None):
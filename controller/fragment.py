@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 网页片段缓存，按模板名和显式传入的变量值缓存渲染结果，重新加载模板时清空
+@time: 2019/3/12
+"""
+
+from collections import OrderedDict
+from tornado import template
+
+
+class FragmentCache(object):
+    """ 容量有限的网页片段缓存，超出容量时淘汰最久未用的片段 """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+class TemplateLoader(template.Loader):
+    """ 模板加载器，重新加载模板(调试模式下每个请求都会重新加载)时清空网页片段缓存 """
+
+    def reset(self):
+        super(TemplateLoader, self).reset()
+        fragment_cache.clear()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 本地页面图的缩略图服务，用 Pillow 在线程池中生成指定尺寸和质量的图，缓存到磁盘，超出容量时淘汰最久未用的。
+       大图还可生成 Deep Zoom 格式的多级切片，切分校对时只取视口内的切片。
+@time: 2019/3/13
+"""
+
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from PIL import Image
+from tornado import gen, web
+
+MAX_SIZE = 4096
+TILE_SIZE = 256
+executor = ThreadPoolExecutor(max_workers=4)  # Pillow 在解码和缩放时释放GIL，线程池即可并行
+
+
+def resize_image(src_file, dst_file, width, height, quality):
+    """ 等比缩放到指定宽高以内，先写临时文件再改名，避免其他进程读到不完整的图 """
+    with Image.open(src_file) as img:
+        img.draft('RGB', (width, height))  # JPEG 解码时直接按比例缩小
+        img.thumbnail((width, height), Image.LANCZOS)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        tmp_file = '%s.%d.%d.tmp' % (dst_file, os.getpid(), threading.get_ident())  # 同一进程的多个线程可能同时生成
+        img.save(tmp_file, 'JPEG', quality=quality, optimize=True)
+    os.replace(tmp_file, dst_file)
+
+
+def tile_levels(width, height):
+    """ Deep Zoom 的最高级别，此级别为原图大小，每低一级宽高减半，第0级为1x1 """
+    return int(math.ceil(math.log(max(width, height, 1), 2)))
+
+
+def build_pyramid(src_file, out_path, tile_size=TILE_SIZE, quality=80):
+    """
+    生成 Deep Zoom 切片：out_path/image.dzi 和 out_path/级别/列_行.jpg。
+    先在临时目录中生成再改名，多个进程同时生成时只保留先完成的
+    """
+    with Image.open(src_file) as src:
+        img = src.convert('RGB') if src.mode not in ('RGB', 'L') else src.copy()  # 复制后即可关闭原图文件
+    width, height = img.size
+    tmp_path = '%s.%d.%d.tmp' % (out_path, os.getpid(), threading.get_ident())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    for level in range(tile_levels(width, height), -1, -1):
+        level_path = path.join(tmp_path, str(level))
+        os.makedirs(level_path)
+        w, h = img.size
+        for col in range(int(math.ceil(w / tile_size))):
+            for row in range(int(math.ceil(h / tile_size))):
+                box = col * tile_size, row * tile_size, min(w, (col + 1) * tile_size), min(h, (row + 1) * tile_size)
+                img.crop(box).save(path.join(level_path, '%d_%d.jpg' % (col, row)), 'JPEG', quality=quality)
+        img = img.resize((max(1, (w + 1) // 2), max(1, (h + 1) // 2)), Image.LANCZOS)
+
+    with open(path.join(tmp_path, 'image.dzi'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="%d" Overlap="0" Format="jpg">'
+                '<Size Width="%d" Height="%d"/></Image>\n' % (tile_size, width, height))
+
+    if path.exists(out_path):
+        shutil.rmtree(out_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, out_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class DiskCache(object):
+    """ 缩略图的磁盘缓存，以文件修改时间作为最近使用时间 """
+
+    def __init__(self, cache_path, max_bytes):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        if not path.exists(cache_path):
+            os.makedirs(cache_path)
+        self.total = sum(size for _, size, _ in self.scan())
+
+    def scan(self):
+        for fn in os.listdir(self.cache_path):
+            filename = path.join(self.cache_path, fn)
+            if fn.endswith('.jpg'):
+                st = os.stat(filename)
+                yield filename, st.st_size, st.st_mtime
+
+    def touch(self, filename):
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+    def added(self, filename, size=None):
+        self.total += path.getsize(filename) if size is None else size
+        if self.total > self.max_bytes:
+            self.trim()
+
+    def remove(self, filename):
+        os.remove(filename)
+
+    def trim(self):
+        """ 淘汰最久未用的文件，直到不超过容量的90%。各进程都写本目录，所以重新扫描得到实际大小 """
+        files = sorted(self.scan(), key=lambda a: a[2])
+        self.total = sum(size for _, size, _ in files)
+        for filename, size, _ in files:
+            if self.total <= self.max_bytes * 0.9:
+                break
+            try:
+                self.remove(filename)
+                self.total -= size
+            except OSError:
+                pass
+
+
+def dir_size(dir_path):
+    return sum(path.getsize(path.join(root, fn)) for root, _, files in os.walk(dir_path) for fn in files)
+
+
+class TileCache(DiskCache):
+    """ 切片的磁盘缓存，以页的切片目录为单位淘汰，以目录中 image.dzi 的修改时间作为最近使用时间 """
+
+    def scan(self):
+        for kind in os.listdir(self.cache_path):
+            kind_path = path.join(self.cache_path, kind)
+            for fn in os.listdir(kind_path) if path.isdir(kind_path) else []:
+                dzi_file = path.join(kind_path, fn, 'image.dzi')
+                if not fn.endswith('.tmp') and path.exists(dzi_file):  # 跳过正在生成的临时目录
+                    yield path.join(kind_path, fn), dir_size(path.join(kind_path, fn)), path.getmtime(dzi_file)
+
+    def touch(self, out_path):
+        super(TileCache, self).touch(path.join(out_path, 'image.dzi'))
+
+    def remove(self, out_path):
+        shutil.rmtree(out_path)
+
+
+class ImageHandler(web.RequestHandler):
+    """ 缩略图: /thumb/藏别/页名.jpg?w=宽&h=高&q=质量 """
+    ACCESS_LOG = 'quiet'
+    URL = r'/thumb/(\w+/\w+)\.(jpg|jpeg|png)'
+    caches = {}
+
+    def initialize(self, path, cache_path, cache_size):
+        self.root = path
+        if cache_path not in self.caches:
+            self.caches[cache_path] = DiskCache(cache_path, cache_size)
+        self.cache = self.caches[cache_path]
+
+    def get_size(self, name, default, low, high):
+        value = self.get_query_argument(name, '')
+        return max(low, min(high, int(value))) if re.match(r'^\d+$', value) else default
+
+    @gen.coroutine
+    def get(self, name, ext):
+        src_file = path.join(self.root, name + '.' + ext)
+        if not path.isfile(src_file):
+            raise web.HTTPError(404)
+
+        width = self.get_size('w', 300, 16, MAX_SIZE)
+        height = self.get_size('h', width, 16, MAX_SIZE)
+        quality = self.get_size('q', 80, 30, 95)
+        st = os.stat(src_file)
+
+        self.set_header('Etag', '"%x-%x-%d-%d-%d"' % (int(st.st_mtime), st.st_size, width, height, quality))
+        self.set_header('Cache-Control', 'public, max-age=86400')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        cache_file = path.join(self.cache.cache_path, '%s_%dx%d_q%d.jpg' % (
+            name.replace('/', '-'), width, height, quality))  # 页名中有下划线而没有减号，用减号分隔才不会重名
+        if path.exists(cache_file) and path.getmtime(cache_file) >= st.st_mtime:
+            self.cache.touch(cache_file)
+        else:
+            try:
+                yield executor.submit(resize_image, src_file, cache_file, width, height, quality)
+            except (IOError, ValueError) as e:
+                logging.error('resize %s: %s' % (src_file, str(e)))
+                raise web.HTTPError(500)
+            self.cache.added(cache_file)
+
+        with open(cache_file, 'rb') as f:
+            self.set_header('Content-Type', 'image/jpeg')
+            self.write(f.read())
+
+
+class TileHandler(web.RequestHandler):
+    """ Deep Zoom 切片: /tile/藏别/页名.dzi 和 /tile/藏别/页名_files/级别/列_行.jpg，首次访问时生成本页的切片 """
+    ACCESS_LOG = 'quiet'
+    URL = [r'/tile/(\w+/\w+)\.dzi', r'/tile/(\w+/\w+)_files/(\d+)/(\d+_\d+)\.jpg']
+    building = {}
+    caches = {}
+
+    def initialize(self, path, tile_path, cache_size):
+        self.root = path
+        self.tile_path = tile_path
+        if tile_path not in self.caches:
+            self.caches[tile_path] = TileCache(tile_path, cache_size)
+        self.cache = self.caches[tile_path]
+
+    @gen.coroutine
+    def get(self, name, level=None, tile=None):
+        src_file = path.join(self.root, name + '.jpg')
+        if not path.isfile(src_file):
+            raise web.HTTPError(404)
+
+        out_path = path.join(self.tile_path, name)
+        dzi_file = path.join(out_path, 'image.dzi')
+        if not path.exists(dzi_file) or path.getmtime(dzi_file) < path.getmtime(src_file):
+            if name not in self.building:
+                self.building[name] = executor.submit(build_pyramid, src_file, out_path)
+            try:
+                yield self.building[name]
+            except (IOError, ValueError) as e:
+                logging.error('build tiles %s: %s' % (src_file, str(e)))
+                raise web.HTTPError(500)
+            finally:
+                self.building.pop(name, None)
+            self.cache.added(out_path, dir_size(out_path))
+        elif level is None:  # 打开页面时先取 image.dzi，每页只需记一次使用时间
+            self.cache.touch(out_path)
+
+        filename = dzi_file if level is None else path.join(out_path, level, tile + '.jpg')
+        if not path.isfile(filename):
+            raise web.HTTPError(404)
+        st = os.stat(filename)
+        self.set_header('Etag', '"%x-%x"' % (int(st.st_mtime), st.st_size))
+        self.set_header('Cache-Control', 'public, max-age=86400')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        with open(filename, 'rb') as f:
+            self.set_header('Content-Type', 'application/xml' if level is None else 'image/jpeg')
+            self.write(f.read())
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 日志的调用位置。跳过 web.py、base.py 和 logging 中的栈帧，使日志记录的是调用这些公共函数的代码位置。
+       按代码对象缓存是否跳过，每条日志只需查字典；配置 log_caller 为 false 时不替换 logging.currentframe
+@time: 2019/3/16
+"""
+
+import logging
+import re
+import sys
+
+SKIP_RE = re.compile(r'(web|base)\.py|logging')
+MAX_CACHE = 10000  # 调试模式下模板会反复编译，缓存过多时清空
+_skip = {}  # 代码对象: 是否跳过
+_old_framer = logging.currentframe
+
+
+def find_caller_frame():
+    """ 返回最外层的连续被跳过的栈帧，logging 从其上一层开始查找调用位置 """
+    f0 = f = sys._getframe(1)
+    while f is not None:
+        code = f.f_code
+        skip = _skip.get(code)
+        if skip is None:
+            if len(_skip) > MAX_CACHE:
+                _skip.clear()
+            skip = _skip[code] = SKIP_RE.search(code.co_filename) is not None
+        if not skip:
+            break
+        f0, f = f, f.f_back
+    return f0
+
+
+def install(enabled=True):
+    logging.currentframe = find_caller_frame if enabled else _old_framer
+
+
+def installed():
+    return logging.currentframe is find_caller_frame
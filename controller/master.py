@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 多进程服务的主进程。主进程监听端口后派生工作进程，工作进程异常退出时重新派生。
+       收到 SIGHUP 时滚动重启：先在子进程中试加载新的代码和配置，成功后主进程保留监听端口重新执行本程序，逐个派生新的工作进程，
+       每个新进程就绪后通知一个旧进程停止接受连接、处理完已有请求后退出；试加载失败时保持原来的工作进程不变。
+       收到 SIGTERM 或 SIGINT 时停止所有工作进程，工作进程忽略 SIGINT (终端中按 Ctrl+C 时由主进程统一停止)。
+       工作进程都就绪后、以及收到 SIGUSR1 时，输出各工作进程独占和共享的内存。
+@time: 2019/3/15
+"""
+
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from tornado import netutil
+
+LISTEN_FDS = 'DZJ_LISTEN_FDS'  # 重新执行时传递监听端口的文件描述符
+OLD_WORKERS = 'DZJ_OLD_WORKERS'  # 重新执行时传递旧工作进程的进程号
+CHECK_ONLY = 'DZJ_CHECK_ONLY'  # 设置时本程序加载代码和配置后即退出，用于滚动重启前的检查
+CHECK_TIMEOUT = 60  # 试加载新代码的最长秒数
+READY_TIMEOUT = 30  # 等待新工作进程就绪的最长秒数
+STOP_TIMEOUT = 60  # 停止服务时等待工作进程退出的最长秒数
+
+
+def memory_info(pid):
+    """ 返回进程的 (独占内存, 共享内存, 按比例分摊的内存) 字节数，不支持时返回None """
+    info = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    info[parts[0][:-1]] = int(parts[1]) * 1024
+    except (IOError, OSError):
+        return None
+    return (info.get('Private_Clean', 0) + info.get('Private_Dirty', 0),
+            info.get('Shared_Clean', 0) + info.get('Shared_Dirty', 0), info.get('Pss', 0))
+
+
+def listen(port):
+    """ 监听端口，滚动重启后沿用原来的监听端口 """
+    fds = os.environ.pop(LISTEN_FDS, '')
+    if fds:
+        sockets = [socket.socket(fileno=int(fd)) for fd in fds.split(',')]
+        for s in sockets:
+            s.setblocking(False)
+        return sockets
+    return netutil.bind_sockets(port, family=socket.AF_INET)
+
+
+class Master(object):
+    def __init__(self, sockets, num_processes):
+        self.sockets = sockets
+        self.num_processes = num_processes
+        self.workers = {}  # 进程号: 工作进程序号
+        self.old_workers = set(int(p) for p in os.environ.pop(OLD_WORKERS, '').split(',') if p)
+        self.ready_fd = None  # 工作进程中通知主进程已就绪的管道
+        self.signal = None
+
+    def fork_processes(self):
+        """ 派生工作进程，在工作进程中返回其序号，在主进程中管理工作进程直到服务停止 """
+        for sig in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1]:
+            signal.signal(sig, self.on_signal)
+
+        old_workers = sorted(self.old_workers)
+        for i in range(self.num_processes):
+            if self.spawn(i):
+                return i
+            if old_workers:  # 新进程就绪后停止一个旧进程
+                self.kill(old_workers.pop(0))
+        for pid in old_workers:
+            self.kill(pid)
+        self.report_memory()
+
+        while self.workers or self.old_workers:
+            if self.signal == signal.SIGUSR1:
+                self.signal = None
+                self.report_memory()
+            if self.signal == signal.SIGHUP:
+                self.reload()
+            elif self.signal:
+                self.stop()
+            pid, i = self.wait()
+            if pid and i is not None and not self.signal:
+                logging.warning('worker #%d (pid %d) exited unexpectedly, restarting' % (i, pid))
+                time.sleep(1)
+                if self.spawn(i):
+                    return i
+        sys.exit(0)
+
+    def on_signal(self, sig, frame):
+        self.signal = sig
+
+    def spawn(self, i):
+        """ 派生第i个工作进程，返回是否在工作进程中。主进程等待新进程通知就绪 """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for sig in [signal.SIGHUP, signal.SIGTERM, signal.SIGUSR1]:
+                signal.signal(sig, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.ready_fd = w
+            self.workers = {}
+            return True
+
+        os.close(w)
+        self.workers[pid] = i
+        if not select.select([r], [], [], READY_TIMEOUT)[0]:
+            logging.warning('worker #%d (pid %d) not ready in %ds' % (i, pid, READY_TIMEOUT))
+        os.close(r)
+        return False
+
+    def notify_ready(self):
+        """ 在工作进程中调用，开始接受连接后通知主进程 """
+        if self.ready_fd is not None:
+            os.write(self.ready_fd, b'1')
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+    def report_memory(self):
+        mb = 1024 * 1024
+        for pid, i in sorted(self.workers.items(), key=lambda a: a[1]):
+            info = memory_info(pid)
+            if info:
+                logging.info('worker #%d (pid %d): unique %.1fMB, shared %.1fMB, pss %.1fMB' % (
+                    i, pid, info[0] / mb, info[1] / mb, info[2] / mb))
+
+    def kill(self, pid, sig=signal.SIGTERM):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def wait(self):
+        """ 回收已退出的工作进程，返回 (进程号, 工作进程序号)，旧进程的序号为None """
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                self.workers.clear()
+                self.old_workers.clear()
+                return None, None
+            raise
+        if not pid:
+            time.sleep(0.5)
+            return None, None
+        self.old_workers.discard(pid)
+        return pid, self.workers.pop(pid, None)
+
+    def check(self):
+        """ 在子进程中试加载新的代码和配置，返回是否成功 """
+        try:
+            code = subprocess.call([sys.executable] + sys.argv, env=dict(os.environ, **{CHECK_ONLY: '1'}),
+                                   timeout=CHECK_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error('check the new code: %s' % str(e))
+            return False
+        if code:
+            logging.error('the new code failed to load (exit code %d)' % code)
+        return code == 0
+
+    def reload(self):
+        """ 试加载成功后保留监听端口和旧工作进程，重新执行本程序，否则继续管理原来的工作进程 """
+        self.signal = None
+        if not self.check():
+            logging.warning('reload cancelled, keep the %d running workers' % len(self.workers))
+            return
+        logging.info('reloading the service, %d workers to replace' % len(self.workers))
+        for s in self.sockets:
+            s.set_inheritable(True)
+        env = dict(os.environ)
+        env[LISTEN_FDS] = ','.join(str(s.fileno()) for s in self.sockets)
+        env[OLD_WORKERS] = ','.join(str(pid) for pid in list(self.workers) + list(self.old_workers))
+        try:
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        except OSError as e:
+            logging.error('reload failed: %s' % str(e))
+
+    def stop(self):
+        """ 通知所有工作进程处理完已有请求后退出，超时后强制结束 """
+        self.signal = signal.SIGTERM
+        deadline = time.time() + STOP_TIMEOUT
+        for pid in list(self.workers) + list(self.old_workers):
+            self.kill(pid)
+        while (self.workers or self.old_workers) and time.time() < deadline:
+            self.wait()
+        for pid in list(self.workers) + list(self.old_workers):
+            self.kill(pid, signal.SIGKILL)
+        self.workers.clear()
+        self.old_workers.clear()
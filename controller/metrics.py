@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 请求耗时统计。各工作进程按响应类、请求方法和状态码累计耗时直方图，按响应类累计文档库命令耗时，定期写到共享目录，
+       /metrics 合并各工作进程的数据，以 Prometheus 文本格式输出。已退出的进程的数据并入 retired.json，重启后计数不会减少
+@time: 2019/3/15
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import path
+
+from tornado import web
+
+try:
+    import fcntl
+except ImportError:  # Windows 下只有单个进程，不需要文件锁
+    fcntl = None
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # 直方图各区间的上限秒数
+NAME = 'dzj_http_request_duration_seconds'
+DB_NAME = 'dzj_db_command_duration_seconds'
+RETIRED = 'retired.json'  # 已退出的各进程的累计数据
+
+
+def merge_data(merged, db, data):
+    """ 将一个进程的数据累加到合并结果中 """
+    for item in data.get('items', []):
+        key, values = tuple(item[:3]), item[3:]
+        if key in merged:
+            merged[key] = [a + b for a, b in zip(merged[key], values)]
+        else:
+            merged[key] = values
+    for name, count, seconds in data.get('db', []):
+        item = db.setdefault(name, [0, 0])
+        item[0] += count
+        item[1] += seconds
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+class Metrics(object):
+    """ 本进程的请求耗时直方图，每项为各区间的请求数(最后一个区间不设上限)和总耗时 """
+    SAVE_INTERVAL = 10  # 写到共享目录的最小间隔秒数
+
+    def __init__(self, metrics_path):
+        self.path = metrics_path
+        self.data = {}
+        self.db = {}  # 响应类: [文档库命令数, 命令总耗时]
+        self.save_time = 0
+        self.filename = None
+
+    def observe(self, handler, seconds):
+        key = type(handler).__name__, handler.request.method, handler.get_status()
+        item = self.data.get(key)
+        if item is None:
+            item = self.data[key] = [0] * (len(BUCKETS) + 2)
+        item[bisect_left(BUCKETS, seconds)] += 1
+        item[-1] += seconds
+        db_count = getattr(handler, 'db_count', 0)
+        if db_count:
+            item = self.db.get(key[0])
+            if item is None:
+                item = self.db[key[0]] = [0, 0]
+            item[0] += db_count
+            item[1] += handler.db_time
+        if time.time() - self.save_time > self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self.save_time = time.time()
+        if not path.exists(self.path):
+            os.makedirs(self.path)
+        if not self.filename:  # 在派生工作进程后首次写出时确定文件名，加上启动时间以免进程号重用时覆盖旧进程的数据
+            self.filename = path.join(self.path, '%d-%d.json' % (os.getpid(), int(self.save_time * 1000)))
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(pid=os.getpid(), items=[list(k) + v for k, v in self.data.items()],
+                           db=[[k] + v for k, v in self.db.items()]), f)
+        os.replace(tmp_file, self.filename)
+
+    @contextmanager
+    def lock(self):
+        """ 各进程合并时互斥，以免重复并入已退出进程的数据 """
+        if not fcntl:
+            yield
+            return
+        with open(path.join(self.path, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def collect(self):
+        """ 合并各工作进程和已退出进程的数据，返回请求耗时和各响应类的文档库耗时 """
+        self.save()
+        merged, db = {}, {}
+        with self.lock():
+            retired, dead = dict(items=[], db=[]), []
+            for fn in sorted(os.listdir(self.path)):
+                if not fn.endswith('.json'):
+                    continue
+                try:
+                    with open(path.join(self.path, fn)) as f:
+                        data = json.load(f)
+                except (IOError, OSError, ValueError):
+                    continue
+                if fn == RETIRED:
+                    retired = data
+                elif not is_alive(data.get('pid', 0)):
+                    dead.append((fn, data))
+                merge_data(merged, db, data)
+
+            if dead:  # 已退出进程的数据并入 retired.json 后删除其文件
+                r_merged, r_db = {}, {}
+                for data in [retired] + [data for fn, data in dead]:
+                    merge_data(r_merged, r_db, data)
+                tmp_file = path.join(self.path, RETIRED + '.tmp')
+                with open(tmp_file, 'w') as f:
+                    json.dump(dict(items=[list(k) + v for k, v in r_merged.items()],
+                                   db=[[k] + v for k, v in r_db.items()]), f)
+                os.replace(tmp_file, path.join(self.path, RETIRED))
+                for fn, data in dead:
+                    os.remove(path.join(self.path, fn))
+        return merged, db
+
+    def export(self):
+        """ 以 Prometheus 文本格式输出累计的直方图 """
+        lines = ['# HELP %s Request duration by handler, method and status.' % NAME, '# TYPE %s histogram' % NAME]
+        merged, db = self.collect()
+        for (handler, method, status), values in sorted(merged.items()):
+            labels = 'handler="%s",method="%s",status="%s"' % (handler, method, status)
+            count = 0
+            for le, n in zip([str(b) for b in BUCKETS] + ['+Inf'], values[:-1]):
+                count += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (NAME, labels, le, count))
+            lines.append('%s_sum{%s} %.6f' % (NAME, labels, values[-1]))
+            lines.append('%s_count{%s} %d' % (NAME, labels, count))
+        lines += ['# HELP %s MongoDB command time by handler.' % DB_NAME, '# TYPE %s summary' % DB_NAME]
+        for handler, (count, seconds) in sorted(db.items()):
+            lines.append('%s_sum{handler="%s"} %.6f' % (DB_NAME, handler, seconds))
+            lines.append('%s_count{handler="%s"} %d' % (DB_NAME, handler, count))
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_allowed(handler):
+    """
+    访问者是否在配置项 metrics_allow 中。服务以 xheaders 运行，remote_ip 取自可伪造的请求头，
+    所以检查套接字的对端地址，经反向代理转发时对端和 remote_ip 都须在其中
+    """
+    allow = handler.application.config.get('metrics_allow', ['127.0.0.1', '::1'])
+    address = getattr(getattr(handler.request.connection, 'context', None), 'address', None)
+    peer = address[0] if isinstance(address, tuple) and address else None
+    return peer in allow and handler.request.remote_ip in allow
+
+
+class MetricsHandler(web.RequestHandler):
+    """ 请求耗时统计: /metrics，只允许配置项 metrics_allow 中的地址访问 """
+    ACCESS_LOG = 'quiet'
+    URL = r'/metrics'
+
+    def get(self):
+        if not metrics_allowed(self):
+            raise web.HTTPError(403)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(self.application.metrics.export())
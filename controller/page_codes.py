@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 页码索引，将 page_codes.json 转为按页名排序的索引文件，各进程内存映射共享，二分查找
+@time: 2019/3/12
+python controller/page_codes.py --json_file=page_codes.json [--index_file=page_codes.idx]
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+from os import path
+
+MAGIC = b'PCI1'
+HEADER = struct.Struct('<4sI')
+OFFSET = struct.Struct('<I')
+
+
+def build(json_file, index_file=None):
+    """ 由页名到页码的JSON文件生成索引文件，先写临时文件再改名，以便读取进程原子地切换 """
+    index_file = index_file or path.splitext(json_file)[0] + '.idx'
+    with open(json_file, encoding='utf-8') as f:
+        codes = json.load(f)
+
+    offsets, data, pos = [], [], 0
+    for name in sorted(codes):
+        record = ('%s\t%s\n' % (name, codes[name])).encode('utf-8')
+        offsets.append(pos)
+        data.append(record)
+        pos += len(record)
+
+    tmp_file = '%s.%d.tmp' % (index_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(offsets)))
+        f.write(b''.join(OFFSET.pack(p) for p in offsets))
+        f.write(b''.join(data))
+    os.replace(tmp_file, index_file)
+    return len(offsets)
+
+
+class PageCodeIndex(object):
+    """ 只读的页码索引，索引文件被替换后自动重新映射 """
+    CHECK_INTERVAL = 5  # 检查索引文件是否改变的最小间隔秒数
+
+    def __init__(self, index_file, json_file=None):
+        self.index_file = index_file
+        self.json_file = json_file
+        self._map = self._stat = None
+        self._count = self._data_pos = 0
+        self._check_time = 0
+        if json_file and path.exists(json_file) and (
+                not path.exists(index_file) or path.getmtime(index_file) < path.getmtime(json_file)):
+            build(json_file, index_file)
+        self._open()
+
+    def __len__(self):
+        self._check()
+        return self._count
+
+    def _open(self):
+        self.close()
+        try:
+            with open(self.index_file, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_size > HEADER.size:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._stat = st.st_ino, st.st_mtime, st.st_size
+        except OSError:
+            self._stat = None
+        if self._map:
+            magic, self._count = HEADER.unpack_from(self._map, 0)
+            assert magic == MAGIC, 'invalid page code index: ' + self.index_file
+            self._data_pos = HEADER.size + self._count * OFFSET.size
+
+    def _check(self):
+        now = time.time()
+        if now - self._check_time >= self.CHECK_INTERVAL:
+            self._check_time = now
+            try:
+                st = os.stat(self.index_file)
+                stat = st.st_ino, st.st_mtime, st.st_size
+            except OSError:
+                stat = None
+            if stat != self._stat:
+                self._open()
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._map = None
+        self._count = 0
+
+    def _record(self, i):
+        start = self._data_pos + OFFSET.unpack_from(self._map, HEADER.size + i * OFFSET.size)[0]
+        end = self._map.find(b'\n', start)
+        return self._map[start:end].split(b'\t', 1)
+
+    def get(self, name, default=None):
+        """ 二分查找页名对应的页码 """
+        self._check()
+        key = name.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            if record[0] < key:
+                lo = mid + 1
+            elif record[0] > key:
+                hi = mid
+            else:
+                return record[1].decode('utf-8')
+        return default
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(build)
@@ -1,19 +1,185 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
+@desc: 后台定时任务。用 @job(名称, 间隔秒数) 登记任务函数，各工作进程都运行调度器，
+       通过文档库 job 表中的租约保证整个集群每个间隔内只有一个进程执行某个任务。
+       任务函数在线程池中执行，不阻塞 IOLoop，每次执行的时间和结果记在 job 表中
 @time: 2018/10/23
 """
 
 import logging
-from datetime import datetime
+import os
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-data = {}
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from tornado import gen, ioloop
 
+import model.user as u
+from controller.errors import get_date_time
 
-def periodic_task(app):
-    if 'update_time' not in data or (datetime.now() - data['update_time']).seconds > 1800:
-        data['update_time'] = datetime.now()
+jobs = {}  # 任务名: Job
+indexed = set()  # 已建立任务索引的库名
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+class Job(object):
+    def __init__(self, name, func, interval, jitter=0.1, timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval  # 间隔秒数
+        self.jitter = jitter  # 间隔随机增减的比例，避免多个任务总是同时执行
+        self.timeout = timeout or interval  # 租约秒数，执行任务的进程异常退出后过了租约期其他进程才能执行
+        self.running = False
+
+    def next_time(self, now):
+        return now + timedelta(seconds=self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+def job(name, interval, jitter=0.1, timeout=None):
+    """ 登记定时任务，任务函数的参数为 app，返回值记在 job 表的 last_result 中 """
+
+    def decorator(func):
+        jobs[name] = Job(name, func, interval, jitter, timeout)
+        return func
+
+    return decorator
+
+
+class Scheduler(object):
+    CHECK_INTERVAL = 10  # 检查是否有任务到期的间隔秒数
+
+    def __init__(self, app):
+        self.app = app
+        self.callback = None
+
+    @property
+    def owner(self):
+        """ 租约的持有者，在派生工作进程前创建本对象，所以每次取当前进程号 """
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def start(self):
+        self.callback = ioloop.PeriodicCallback(self.check, 1000 * self.CHECK_INTERVAL * random.uniform(0.9, 1.1))
+        self.callback.start()
+
+    def stop(self):
+        if self.callback:
+            self.callback.stop()
+
+    def check(self):
+        for j in jobs.values():
+            if not j.running:
+                ioloop.IOLoop.current().spawn_callback(self.run, j)
+
+    @gen.coroutine
+    def run(self, j):
+        """ 取得租约后在线程池中执行任务，返回是否执行了 """
+        j.running = True
+        try:
+            if not (yield executor.submit(self.acquire, j)):
+                return False
+            start, result, status = datetime.now(), None, 'ok'
+            try:
+                result = yield executor.submit(j.func, self.app)
+            except Exception as e:
+                status = '%s: %s' % (e.__class__.__name__, str(e))
+                logging.error('job %s failed: %s' % (j.name, status))
+            yield executor.submit(self.release, j, start, status, result)
+            return True
+        except PyMongoError as e:
+            logging.error('job %s: %s' % (j.name, str(e)))
+        finally:
+            j.running = False
+
+    def acquire(self, j):
+        """ 已到执行时间且没有其他进程持有租约时取得租约，第一次执行时插入任务记录 """
+        now = datetime.now()
         try:
-            pass
-        except Exception as e:
-            logging.error('periodic_db_task: %s %s' % (e.__class__.__name__, str(e)))
+            r = self.app.db.job.find_one_and_update(
+                {'_id': j.name, 'next_time': {'$lte': now}, 'lease_time': {'$lte': now}},
+                {'$set': dict(owner=self.owner, lease_time=now + timedelta(seconds=j.timeout),
+                              next_time=j.next_time(now), start_time=now)},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:  # 任务记录已存在但未到期或租约未过期
+            return False
+        return bool(r and r.get('owner') == self.owner)
+
+    def release(self, j, start, status, result):
+        now = datetime.now()
+        self.app.db.job.update_one(
+            dict(_id=j.name, owner=self.owner),
+            {'$set': dict(lease_time=now, end_time=now, last_status=status, last_result=result,
+                          last_seconds=round((now - start).total_seconds(), 3)),
+             '$inc': dict(runs=1, errors=int(status != 'ok'))})
+
+
+def create_task_indexes(db):
+    """
+    建立页面任务的索引，每个库只建一次：
+    各类任务的领取时间建立只含进行中任务的部分索引，便于查找超时的任务；
+    各类任务的状态建立索引，便于按状态统计；页名和版本号的组合索引使计算状态列表的ETag时只需扫描索引
+    """
+    if db.name in indexed:
+        return
+    for t in u.task_types:
+        db.page.create_index([(t + '_status', ASCENDING), (t + '_start_time', ASCENDING)],
+                             name=t + '_locked', partialFilterExpression={t + '_status': u.STATUS_LOCKED})
+        db.page.create_index(t + '_status')
+    db.page.create_index([('name', ASCENDING), ('version', ASCENDING)])
+    indexed.add(db.name)
+
+
+@job('reclaim_locks', 600)
+def reclaim_locks(app):
+    """ 将领取后超时未提交的任务退回，以便他人领取。超时小时数由配置项 task_timeout_hours 按任务类型指定 """
+    db, now = app.db, datetime.now()
+    create_task_indexes(db)
+
+    timeouts = app.config.get('task_timeout_hours') or {}
+    result = {}
+    for t in u.task_types:
+        hours = timeouts.get(t, timeouts.get('default', 24))
+        task_user, task_status = t + '_user', t + '_status'
+        cond = {task_status: u.STATUS_LOCKED, t + '_start_time': {'$lt': now - timedelta(hours=hours)}}
+        update = {'$set': {task_status: u.STATUS_RETURNED}, '$unset': {task_user: '', t + '_nickname': ''},
+                  '$inc': {'version': 1}}
+        pages = []
+        for p in db.page.find(cond, {'name': 1, task_user: 1}):
+            # 逐页按超时条件退回，查找后已提交或被重新领取的页面不会匹配，也就不记日志
+            r = db.page.update_one(dict(cond, _id=p['_id']), update)
+            if r.modified_count:
+                pages.append(p)
+        if not pages:
+            continue
+        result[t] = len(pages)
+        logging.info('reclaim_%s: %d pages locked over %sh, %s' % (
+            t, len(pages), hours, ','.join(p['name'] for p in pages[:20])))
+        db.log.insert_many([dict(type='reclaim_' + t, user_id=p.get(task_user), file_id=str(p['_id']),
+                                 context=p['name'], create_time=get_date_time(), ip='') for p in pages])
+    return result
+
+
+@job('rebuild_user_stats', 3600 * 6)
+def rebuild_user_stats(app):
+    """ 由页面的任务状态重新统计各用户完成的任务数。提交任务时只累加计数，任务被退回或重新发布后由本任务校正 """
+    db, stats = app.db, {}
+    done = [{'$cond': [{'$eq': ['$' + t + '_status', u.STATUS_ENDED]},
+                       {'t': {'$literal': t}, 'user': '$' + t + '_user'}, None]} for t in u.task_types]
+    for r in db.page.aggregate([{'$match': {'$or': [{t + '_status': u.STATUS_ENDED} for t in u.task_types]}},
+                                {'$project': {'_id': 0, 'done': done}}, {'$unwind': '$done'},
+                                {'$match': {'done.user': {'$ne': None}}},
+                                {'$group': {'_id': '$done', 'count': {'$sum': 1}}}], allowDiskUse=True):
+        t, user_id = r['_id']['t'], r['_id']['user']
+        s = stats.setdefault(user_id, dict.fromkeys(u.stat_fields, 0))
+        s[t] = r['count']
+        s[u.stat_of_task[t]] += r['count']
+
+    now = datetime.now()
+    if stats:
+        db.user_stat.bulk_write([ReplaceOne({'_id': k}, dict(v, update_time=now), upsert=True)
+                                 for k, v in stats.items()], ordered=False)
+    db.user_stat.delete_many({'_id': {'$nin': list(stats)}})
+    return len(stats)
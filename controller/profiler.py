@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 慢请求采样分析。启用后各工作进程的后台线程定时抓取主线程的调用栈，计入栈中正在执行的响应对象，
+       请求结束时耗时超过阈值或按比例抽中的，将合并的调用栈(可用 flamegraph.pl 绘图)写到分析目录，只保留最近的若干个。
+       /debug/profiles 按耗时列出最慢的分析结果
+@time: 2019/3/17
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from os import path
+
+from tornado import web
+from tornado.options import options
+
+from controller.metrics import metrics_allowed
+
+
+class Profiler(object):
+    MAX_ACTIVE = 1000  # 正在采样的请求数上限
+
+    def __init__(self, profile_path, threshold_ms=0, sample=0, interval_ms=5, keep=200):
+        self.path = profile_path
+        self.threshold = threshold_ms / 1000.0 if threshold_ms else None  # 耗时超过此秒数的请求都记录
+        self.sample = sample or 0  # 其余请求的记录比例
+        self.interval = interval_ms / 1000.0  # 抓取调用栈的间隔秒数
+        self.keep = keep  # 保留的分析结果个数
+        self.enabled = bool(self.threshold or self.sample)
+        self.active = {}  # 响应对象的id: 该请求的 {合并的调用栈: 采样次数}
+        self.labels = {}  # 代码对象: 调用栈中的显示名
+        self.pending = deque()  # 待写出的分析结果
+        self.event = threading.Event()
+        self.thread = self.pid = self.ident = None
+        self.root = path.dirname(path.dirname(path.abspath(__file__))) + os.sep
+
+    def start(self, handler):
+        """ 开始采样一个请求，在 IOLoop 线程中调用 """
+        if self.pid != os.getpid():
+            self.start_thread()
+        if len(self.active) > self.MAX_ACTIVE:  # 连接中断等未调用 finish 的请求
+            self.active.clear()
+        self.active[id(handler)] = {}
+
+    def finish(self, handler):
+        """ 请求结束时决定是否记录其采样结果 """
+        stacks = self.active.pop(id(handler), None)
+        stacks = stacks and dict(stacks)  # 采样线程可能仍在写入，取其副本
+        if not stacks:
+            return
+        seconds = handler.request.request_time()
+        if self.threshold and seconds >= self.threshold or random.random() < self.sample:
+            request, user = handler.request, getattr(handler, '_current_user', None)
+            user = user and (getattr(user, 'name', None) or isinstance(user, dict) and user.get('name')) or None
+            self.pending.append(dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), pid=os.getpid(),
+                                     handler=type(handler).__name__, method=request.method, uri=request.uri,
+                                     user=user, status=handler.get_status(), ms=round(seconds * 1000, 1),
+                                     interval_ms=self.interval * 1000, samples=sum(stacks.values()),
+                                     stacks=stacks))
+
+    def start_thread(self):
+        """ 在本进程中启动采样线程，派生工作进程后各自启动 """
+        self.pid, self.ident = os.getpid(), threading.current_thread().ident
+        self.active.clear()
+        self.event.clear()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread and self.pid == os.getpid():
+            self.event.set()
+            self.thread.join(5)
+        self.thread = self.pid = None
+
+    def run(self):
+        while not self.event.wait(self.interval):
+            if self.active:
+                self.take_sample()
+            if self.pending:
+                self.save()
+        self.save()
+
+    def label(self, code):
+        name = self.labels.get(code)
+        if name is None:
+            fn = code.co_filename
+            fn = fn[len(self.root):] if fn.startswith(self.root) else path.basename(fn)
+            name = self.labels[code] = '%s:%s:%d' % (fn, code.co_name, code.co_firstlineno)
+        return name
+
+    def take_sample(self):
+        """ 抓取主线程的调用栈，计入栈中找到的第一个正在采样的响应对象(call_api 内部调用的不采样，计入外层发起者) """
+        frame = sys._current_frames().get(self.ident)
+        stack, stacks = [], None
+        while frame is not None:
+            code = frame.f_code
+            stack.append(self.label(code))
+            if stacks is None and code.co_argcount and code.co_varnames[0] == 'self':
+                stacks = self.active.get(id(frame.f_locals.get('self')))
+            frame = frame.f_back
+        if stacks is not None:
+            key = ';'.join(reversed(stack))
+            stacks[key] = stacks.get(key, 0) + 1
+
+    def save(self):
+        if not self.pending:
+            return
+        try:
+            if not path.exists(self.path):
+                os.makedirs(self.path)
+            while self.pending:
+                item = self.pending.popleft()
+                fn = '%s_%d_%s_%d.json' % (time.strftime('%Y%m%d%H%M%S'), item['pid'], item['handler'], item['ms'])
+                with open(path.join(self.path, fn), 'w') as f:
+                    json.dump(item, f, ensure_ascii=False)
+            files = sorted(fn for fn in os.listdir(self.path) if fn.endswith('.json'))
+            for fn in files[:-self.keep]:
+                os.remove(path.join(self.path, fn))
+        except (IOError, OSError) as e:
+            logging.warning('save profile: %s' % str(e))
+
+    def top(self, count=20, functions=10):
+        """ 按耗时降序返回最慢的分析结果，每项含采样最多的函数(栈顶)和调用路径(栈中的本项目函数) """
+        items = []
+        for fn in os.listdir(self.path) if path.exists(self.path) else []:
+            try:
+                with open(path.join(self.path, fn)) as f:
+                    item = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            leaves, paths = {}, {}
+            for stack, n in item.pop('stacks').items():
+                frames = stack.split(';')
+                leaves[frames[-1]] = leaves.get(frames[-1], 0) + n
+                own = ';'.join(f for f in frames if f.split(':')[0].startswith(('controller', 'model')))
+                paths[own] = paths.get(own, 0) + n
+            item.update(name=fn, functions=sorted(leaves.items(), key=lambda a: -a[1])[:functions],
+                        paths=sorted(paths.items(), key=lambda a: -a[1])[:functions])
+            items.append(item)
+        return sorted(items, key=lambda a: -a['ms'])[:count]
+
+
+class ProfilesHandler(web.RequestHandler):
+    """ 慢请求分析结果: /debug/profiles?count=数量，/debug/profiles/文件名 输出合并的调用栈。调试模式或 metrics_allow 中的地址可访问 """
+    ACCESS_LOG = 'quiet'
+    URL = [r'/debug/profiles', r'/debug/profiles/([\w.]+\.json)']
+
+    def get(self, name=None):
+        if not options.debug and not metrics_allowed(self):
+            raise web.HTTPError(403)
+        self.set_header('Cache-Control', 'no-cache')
+        profiler = self.application.profiler
+        if name:
+            filename = path.join(profiler.path, name)
+            if not path.exists(filename):
+                raise web.HTTPError(404)
+            with open(filename) as f:
+                stacks = json.load(f)['stacks']
+            self.set_header('Content-Type', 'text/plain; charset=utf-8')
+            return self.write(''.join('%s %d\n' % (k, v) for k, v in sorted(stacks.items())))
+        try:
+            count = int(self.get_query_argument('count', 20))
+        except ValueError:
+            raise web.HTTPError(400, 'invalid count')
+        self.write(dict(enabled=profiler.enabled, items=profiler.top(min(max(1, count), 1000))))
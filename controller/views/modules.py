@@ -5,14 +5,20 @@
 @file: modules.py
 @time: 2018/12/22
 """
+from tornado.escape import xhtml_escape
 from tornado.web import UIModule
 
 
 class CommonLeft(UIModule):
     def render(self, title='', sub=''):
-        return self.render_string('common_left.html', title=title, sub=sub)
+        authority = self.current_user and self.current_user.authority or ''
+        return self.handler.render_fragment('common_left.html', title=title, sub=sub, authority=authority)
 
 
 class CommonHead(UIModule):
+    USER_NAME = '<!--user_name-->'  # 片段中用户名的占位符，片段按权限缓存，不必每个用户各存一份
+
     def render(self):
-        return self.render_string('common_head.html')
+        authority = self.current_user and self.current_user.authority or ''
+        html = self.handler.render_fragment('common_head.html', authority=authority)
+        return html.replace(self.USER_NAME, xhtml_escape(self.current_user and self.current_user.name or ''))
@@ -7,12 +7,16 @@
 
 from tornado.web import authenticated
 from controller.base import BaseHandler, DbError, convert_bson
+from controller.api.task.task import GetPagesApi, PickCutProofTaskApi, PickCutReviewTaskApi
+from controller.image import TILE_SIZE, tile_levels
+from PIL import Image
+from os import path
 import random
 import re
-import json
-from os import path
 import model.user as u
 
+TILE_BASE_SIZE = 1024  # 分切片显示的大图的底图宽高
+
 
 def get_my_or_free_tasks(self, task_type, max_count=12):
     """ 查找未领取或自己未完成的任务 """
@@ -196,39 +200,50 @@ class CutProofDetailHandler(BaseHandler):
     @authenticated
     def get(self, box_type, stage, name):
         """ 进入切分校对 """
+        task_type = '%s_cut_%s' % (box_type, stage)
+        task_name = '%s切分' % dict(block='栏', column='列', char='字')[box_type]
+        try:
+            body = self.call_api(PickCutProofTaskApi if stage == 'proof' else PickCutReviewTaskApi, box_type, name)
+            if body.get('error'):
+                return self.render('_error.html', code=body['code'], error=body['error'])
 
-        def handle_response(body):
-            try:
-                page = convert_bson(self.db.page.find_one(dict(name=name)))
-                if not page:
-                    return self.render('_404.html')
+            # 切分框数据由页面通过 GetPageBoxesApi 另取，不嵌入网页中
+            page = convert_bson(self.db.page.find_one(dict(name=name), dict(blocks=0, columns=0, chars=0, txt=0)))
+            if not page:
+                return self.render('_404.html')
 
-                self.render('dzj_cut_detail.html', page=page,
-                            readonly=body.get('name') != name,
-                            title='切分校对' if stage == 'proof' else '切分审定',
-                            get_img=self.get_img,
-                            box_type=box_type, stage=stage, task_type=task_type, task_name=task_name)
-            except Exception as e:
-                self.send_db_error(e, render=True)
+            self.render('dzj_cut_detail.html', page=page,
+                        readonly=body.get('name') != name,
+                        title='切分校对' if stage == 'proof' else '切分审定',
+                        get_img=self.get_img, tiles=self.get_tiles(name),
+                        box_type=box_type, stage=stage, task_type=task_type, task_name=task_name)
+        except Exception as e:
+            self.send_db_error(e, render=True)
 
-        task_type = '%s_cut_%s' % (box_type, stage)
-        task_name = '%s切分' % dict(block='栏', column='列', char='字')[box_type]
-        self.call_back_api('/api/pick/{0}/{1}'.format(task_type, name), handle_response)
-
-    def get_img(self, name):
-        cfg = self.application.config
-        if 'page_codes' not in cfg:
-            try:
-                cfg['page_codes'] = json.load(open(path.join(self.application.BASE_DIR, 'page_codes.json')))
-            except OSError:
-                cfg['page_codes'] = {}
-        code = cfg['page_codes'].get(name)
+    def get_img(self, name, tiles=None):
+        code = self.application.page_codes.get(name)
         if code:
             base_url = 'http://tripitaka-img.oss-cn-beijing.aliyuncs.com/page'
             url = '/'.join([base_url, *name.split('_')[:-1], name + '_' + code + '.jpg'])
             return url + '?x-oss-process=image/resize,m_lfit,h_300,w_300'
 
-        return '/static/img/{0}/{1}.jpg'.format(name[:2], name)
+        if tiles:  # 分切片显示时底图只用缩略图
+            return '/thumb/{0}/{1}.jpg?w={2}'.format(name[:2], name, TILE_BASE_SIZE)
+        return '/thumb/{0}/{1}.jpg?w=300&h=300&q=80'.format(name[:2], name)  # 与在线图的缩放参数一致
+
+    def get_tiles(self, name):
+        """ 本地的大图按 Deep Zoom 切片显示，返回切片参数，否则返回None """
+        filename = path.join(self.application.IMAGE_PATH, name[:2], name + '.jpg')
+        if self.application.page_codes.get(name) or not path.exists(filename):
+            return None
+        try:
+            with Image.open(filename) as im:  # 只读文件头
+                width, height = im.size
+        except IOError:
+            return None
+        if max(width, height) <= TILE_BASE_SIZE * 2:
+            return None
+        return dict(url='/tile/{0}/{1}'.format(name[:2], name), tileSize=TILE_SIZE, maxLevel=tile_levels(width, height))
 
 
 class CharProofDetailHandler(BaseHandler):
@@ -254,13 +269,13 @@ class CutStatusHandler(BaseHandler):
     def get(self):
         """ 任务管理-切分状态 """
 
-        def handle_response(body):
-            self.render('dzj_task_cut_status.html',
-                        status_cls=CutStatusHandler.status_cls,
-                        status_desc=CutStatusHandler.status_desc,
-                        sum_status=CutStatusHandler.sum_status, **body)
-
-        self.call_back_api('/api/pages/cut_status', handle_response)
+        body = self.call_api(GetPagesApi, 'cut_status')
+        if body.get('error'):
+            return self.render('_error.html', code=body['code'], error=body['error'])
+        self.render('dzj_task_cut_status.html',
+                    status_cls=CutStatusHandler.status_cls,
+                    status_desc=CutStatusHandler.status_desc,
+                    sum_status=CutStatusHandler.sum_status, **body)
 
     @staticmethod
     def status_desc(page, prefix):
@@ -272,13 +287,15 @@ class CutStatusHandler(BaseHandler):
         return 'status_' + page.get(prefix + '_status', 'none')
 
     @staticmethod
-    def sum_status(pages, prefix):
-        values = []
-        for p in pages:
-            v = CutStatusHandler.status_desc(p, prefix)
-            if v not in values:
-                values.append(v)
-        return values
+    def sum_status(stats, prefix):
+        """ 由各藏别、各册的状态直方图汇总得到某任务类型的各状态描述及页数 """
+        counts = {}
+        for volume_stats in [v for kind_stats in stats.values() for v in kind_stats.values()]:
+            for status, count in volume_stats.get(prefix, {}).items():
+                desc = u.task_statuses.get(None if status == 'none' else status)
+                counts[desc] = counts.get(desc, 0) + count
+        order = list(u.task_statuses.values())
+        return sorted(counts.items(), key=lambda a: order.index(a[0]) if a[0] in order else -1)
 
 
 class TextStatusHandler(BaseHandler):
@@ -288,10 +305,10 @@ class TextStatusHandler(BaseHandler):
     def get(self):
         """ 任务管理-文字状态 """
 
-        def handle_response(body):
-            self.render('dzj_task_char_status.html',
-                        status_cls=CutStatusHandler.status_cls,
-                        status_desc=CutStatusHandler.status_desc,
-                        sum_status=CutStatusHandler.sum_status, **body)
-
-        self.call_back_api('/api/pages/text_status', handle_response)
+        body = self.call_api(GetPagesApi, 'text_status')
+        if body.get('error'):
+            return self.render('_error.html', code=body['code'], error=body['error'])
+        self.render('dzj_task_char_status.html',
+                    status_cls=CutStatusHandler.status_cls,
+                    status_desc=CutStatusHandler.status_desc,
+                    sum_status=CutStatusHandler.sum_status, **body)
@@ -6,6 +6,7 @@
 """
 
 from tornado.web import authenticated
+from controller import errors
 from controller.base import BaseHandler, fetch_authority, DbError
 import model.user as u
 
@@ -80,26 +81,44 @@ class UsersDataHandler(BaseHandler):
 
     @authenticated
     def get(self):
-        """ 人员管理-数据管理页面 """
+        """ 人员管理-数据管理页面，各项数量取自 user_stat 表，可按 order 排序(前缀-为降序)、按 page 分页 """
+        order = self.get_query_argument('order', 'name')
+        if order.lstrip('-') not in ['name'] + list(u.stat_fields):
+            order = 'name'
+        try:
+            page_no = max(1, int(self.get_query_argument('page', 1)))
+            page_size = min(max(1, int(self.get_query_argument('page_size', 50))), 1000)
+        except ValueError:
+            return self.send_error(errors.invalid_parameter, render=True)
+
         fields = ['id', 'name', 'phone']
         try:
             self.update_login()
-            users = self.db.user.find({})
+            # 在文档库中排序和分页，按统计项排序时没有统计记录的用户计为0
+            key, direction = order.lstrip('-'), -1 if order.startswith('-') else 1
+            page = [{'$skip': (page_no - 1) * page_size}, {'$limit': page_size}]
+            lookup = [{'$lookup': {'from': 'user_stat', 'localField': 'id', 'foreignField': '_id', 'as': 'stat'}}]
+            if key == 'name':
+                pipeline = [{'$sort': {'name': direction}}] + page + lookup
+            else:
+                pipeline = lookup + [{'$addFields': {key: {'$ifNull': [{'$arrayElemAt': ['$stat.' + key, 0]}, 0]}}},
+                                     {'$sort': {key: direction, 'name': 1}}] + page
+            users = list(self.db.user.aggregate(pipeline))
+            stats = [(r.get('stat') or [{}])[0] for r in users]
             users = [self.fetch2obj(r, u.User, fetch_authority, fields=fields) for r in users]
-            users.sort(key=lambda a: a.name)
             users = self.convert_for_send(users)
-            for r in users:
+            for r, stat in zip(users, stats):
                 # 切分校对数量、切分审定数量、文字校对数量、文字审定数量、文字难字数量、文字反馈数量、格式标注数量、格式审定数量
-                r.update(dict(cut_proof_count=0, cut_review_count=0,
-                              text_proof_count=0, text_review_count=0,
-                              text_difficult_count=0, text_feedback_count=0,
-                              fmt_proof_count=0, fmt_review_count=0))
+                r.update({f: stat.get(f, 0) for f in u.stat_fields})
+            total = self.db.user.count_documents({})
             self.add_op_log('get_users_completed')
 
-        except Exception as e:
+        except DbError as e:
             return self.send_db_error(e, render=True)
 
-        self.render('dzj_user_data.html', users=users)
+        self.render('dzj_user_data.html', users=users, order=order, page_no=page_no, page_size=page_size,
+                    page_count=max(1, (total + page_size - 1) // page_size), total=total)
+
 
 class UsersProfileHandler(BaseHandler):
     URL = '/user/profile'
@@ -110,4 +129,4 @@ class UsersProfileHandler(BaseHandler):
         # 把user这个“对象”类型转换为“dict”类型
         user = self.convert2dict(user)
         # 把参数渲染到html上
-        self.render('user_profile.html', user=user)
\ No newline at end of file
+        self.render('user_profile.html', user=user)
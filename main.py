@@ -7,19 +7,30 @@
 
 import logging
 import os
-import socket
+import signal
+import sys
 from functools import partial
 
-from tornado import ioloop, netutil, process
+from tornado import gen, ioloop
 from tornado.httpserver import HTTPServer
 from tornado.options import define, options as opt
 
 import controller as c
 from controller.app import Application
-from controller.periodic import periodic_task
+from controller.master import CHECK_ONLY, Master, listen
 
 define('num_processes', default=4, help='sub-processes count', type=int)
 
+
+@gen.coroutine
+def stop_worker(app, server):
+    """ 收到 SIGTERM 时停止接受连接，处理完已有请求后退出 """
+    logging.info('Stopping the service, %d requests in progress' % app.requests)
+    yield app.stop(server)
+    ioloop.IOLoop.current().stop()
+    logging.info('Stop the service')
+
+
 if __name__ == '__main__':
     opt.parse_command_line()
     opt.debug = opt.debug and opt.port not in [80, 443]
@@ -27,18 +38,25 @@ if __name__ == '__main__':
                       default_handler_class=c.InvalidPageHandler,
                       ui_modules=c.modules,
                       xsrf_cookies=True)
+    if os.environ.get(CHECK_ONLY):  # 滚动重启前由主进程试加载新的代码和配置
+        sys.exit(0)
     try:
         ssl_options = not opt.debug and app.site.get('https') or None
 
         server = HTTPServer(app, xheaders=True, ssl_options=ssl_options)
-        sockets = netutil.bind_sockets(opt.port, family=socket.AF_INET)
-        fork_id = 0 if opt.debug or os.name == 'nt' else process.fork_processes(opt.num_processes)
+        sockets = listen(opt.port)
+        master = Master(sockets, opt.num_processes)
+        if not opt.debug and os.name != 'nt':
+            app.preload()
+        fork_id = 0 if opt.debug or os.name == 'nt' else master.fork_processes()
         server.add_sockets(sockets)
+        master.notify_ready()
 
         logging.info('Start the service #%d v%s on %s://localhost:%d' % (
             fork_id, app.version, 'https' if ssl_options else 'http', opt.port))
-        if fork_id == 0:
-            ioloop.PeriodicCallback(partial(periodic_task, app), 1000 * 300).start()
+        app.scheduler.start()  # 各进程都运行，由任务租约保证每个任务同时只在一个进程中执行
+        signal.signal(signal.SIGTERM, lambda sig, frame: ioloop.IOLoop.current().add_callback_from_signal(
+            partial(stop_worker, app, server)))
         ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
         app.stop()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 切分框的几何检查，用 NumPy 对一页的栏框、列框、字框整体计算，检查越界、宽高、重叠和包含关系
+@time: 2019/3/14
+"""
+
+import numpy as np
+
+MARGIN = 2  # 允许超出页面的像素
+MIN_SIZE = 2  # 框的最小宽高
+OVERLAP_RATIO = 0.5  # 同类框的相交面积超过较小框的这个比例即为重叠
+CONTAIN_RATIO = 0.8  # 框在上级框内的面积至少为这个比例
+CHUNK = 256  # 两两相交时每次计算的行数，每块随即归约，内存占用为 CHUNK x 框数
+
+box_names = dict(blocks='栏框', columns='列框', chars='字框')
+box_parents = dict(columns='blocks', chars='columns')
+box_ids = dict(blocks='block_id', columns='column_id', chars='char_id')
+GEOMETRY = ('x', 'y', 'w', 'h')
+
+
+def merge_boxes(box_type, boxes, old_boxes):
+    """
+    由提交的切分框生成要保存的框：只取提交的位置，按ID沿用原有框的其余字段(ID、序号、文字等)。
+    前端会为框生成临时ID和序号，ID不是原有框的视为新框，只保存位置
+    """
+    key = box_ids[box_type]
+    old = dict((b[key], b) for b in old_boxes or [] if b.get(key))
+    ret = []
+    for b in boxes:
+        box = dict(old.pop(b.get(key), None) or {})  # 同一ID只沿用一次
+        box.update((k, b.get(k)) for k in GEOMETRY)
+        ret.append(box)
+    return ret
+
+
+def to_array(boxes):
+    """ 转为 N x 4 的 x, y, w, h 数组，缺少或无效的值为 nan """
+
+    def value(b, k):
+        try:
+            return float(b.get(k))
+        except (TypeError, ValueError):
+            return np.nan
+
+    return np.array([[value(b, k) for k in 'xywh'] for b in boxes], dtype=float).reshape(-1, 4)
+
+
+def intersect(a, b):
+    """ 分块计算两两相交面积，逐块生成 (起始行号, 最多 CHUNK x len(b) 的相交面积)，由调用者随即归约 """
+    for i in range(0, len(a), CHUNK):
+        c = a[i: i + CHUNK, None, :]
+        w = np.minimum(c[..., 0] + c[..., 2], b[None, :, 0] + b[None, :, 2]) - np.maximum(c[..., 0], b[None, :, 0])
+        h = np.minimum(c[..., 1] + c[..., 3], b[None, :, 1] + b[None, :, 3]) - np.maximum(c[..., 1], b[None, :, 1])
+        np.clip(w, 0, None, out=w)
+        np.clip(h, 0, None, out=h)
+        w *= h
+        yield i, w
+
+
+def overlaps(v, area):
+    """ 返回同类框中重叠的 (i, j) 序号对，i < j，按 i、j 排序 """
+    pairs = []
+    for i0, inter in intersect(v, v):
+        inter /= np.minimum(area[i0: i0 + CHUNK, None], area[None, :])
+        rows, cols = np.nonzero(inter > OVERLAP_RATIO)
+        rows += i0
+        keep = cols > rows
+        pairs.extend(zip(rows[keep].tolist(), cols[keep].tolist()))
+    return pairs
+
+
+def check_boxes(width, height, **boxes):
+    """
+    检查一页的切分框，参数为 blocks、columns、chars 框列表，只检查传入的类型。
+    :return: 问题列表 [dict(type=框类型, index=序号, id=框编号, error=说明, fatal=是否为无效或越界)]，没有问题则为空
+    """
+    problems = []
+    arrays = dict((t, to_array(b)) for t, b in boxes.items() if b is not None)
+
+    def report(box_type, indexes, error, fatal=False):
+        for i in np.asarray(indexes).tolist():
+            b = boxes[box_type][i]
+            problems.append(dict(type=box_type, index=i, error=error, fatal=fatal,
+                                 id=b.get(box_type[:-1] + '_id') or b.get('char_id')))
+
+    for t, a in arrays.items():
+        if not len(a):
+            continue
+        x, y, w, h = a.T
+        with np.errstate(invalid='ignore'):
+            invalid = ~np.isfinite(a).all(axis=1) | (w < MIN_SIZE) | (h < MIN_SIZE)
+            outside = ~invalid & ((x < -MARGIN) | (y < -MARGIN) | (x + w > width + MARGIN) | (y + h > height + MARGIN))
+        report(t, np.nonzero(invalid)[0], '%s的位置或宽高无效' % box_names[t], True)
+        report(t, np.nonzero(outside)[0], '%s超出页面' % box_names[t], True)
+
+        valid = np.nonzero(~invalid)[0]
+        v, area = a[valid], w[valid] * h[valid]
+        for i, j in overlaps(v, area):
+            report(t, [valid[j]], '%s与第%d个%s重叠' % (box_names[t], valid[i] + 1, box_names[t]))
+
+        parent = box_parents.get(t)
+        p = arrays.get(parent)
+        if p is not None and len(p) and len(valid):
+            p = p[np.isfinite(p).all(axis=1)]
+            inside = np.concatenate([inter.max(axis=1) for _, inter in intersect(v, p)]) / area \
+                if len(p) else np.zeros(len(v))
+            report(t, valid[inside < CONTAIN_RATIO], '%s不在任何%s内' % (box_names[t], box_names[parent]))
+
+    return problems
@@ -52,6 +52,14 @@ task_types = ['block_cut_proof', 'column_cut_proof', 'char_cut_proof',
               'text_proof_1', 'text_proof_2', 'text_proof_3', 'text_review',
               'fmt_proof', 'fmt_review', 'hard_proof']
 re_task_type = '|'.join(task_types)
+
+# 人员数据统计的各项及计入的任务类型。user_stat 表中每个用户一条记录(_id为用户id)，含各任务类型和各统计项的完成数
+stat_fields = dict(cut_proof_count=['block_cut_proof', 'column_cut_proof', 'char_cut_proof'],
+                   cut_review_count=['block_cut_review', 'column_cut_review', 'char_cut_review'],
+                   text_proof_count=['text_proof_1', 'text_proof_2', 'text_proof_3'],
+                   text_review_count=['text_review'], text_difficult_count=['hard_proof'], text_feedback_count=[],
+                   fmt_proof_count=['fmt_proof'], fmt_review_count=['fmt_review'])
+stat_of_task = {t: f for f, types in stat_fields.items() for t in types}
 re_cut_type = '(block|column|char)_cut_(proof|review)'
 task_type_authority = dict(block_cut_proof='cut_proof', column_cut_proof='cut_proof', char_cut_proof='cut_proof',
                            block_cut_review='cut_review', column_cut_review='cut_review', char_cut_review='cut_review',
@@ -504,6 +504,7 @@
       state.focus = true;
 
       data.image = data.paper.image(p.image, 0, 0, p.width, p.height);
+      data.tiles = p.tiles && $.extend({level: -1, shown: {}}, p.tiles);
       data.board = data.paper.rect(0, 0, p.width, p.height)
         .attr({'stroke': 'transparent', fill: data.boxFill});
 
@@ -563,6 +564,10 @@
       self.switchCurrentBox(leftTop);
       self.setRatio(1);
       undoData.load(p.name, self._apply.bind(self));
+      if (data.tiles) {
+        (data.scrollContainer || $(window)).off('scroll.tiles resize.tiles')
+          .on('scroll.tiles resize.tiles', self.showTiles.bind(self));
+      }
 
       return data;
     },
@@ -577,6 +582,10 @@
         data.board.remove();
         delete data.board;
       }
+      if (data.tiles) {
+        (data.scrollContainer || $(window)).off('scroll.tiles resize.tiles');
+        delete data.tiles;
+      }
       data.chars.forEach(function(b) {
         if (b.shape) {
           b.shape.remove();
@@ -589,6 +598,39 @@
       }
     },
 
+    // 大图按 Deep Zoom 切片显示：image 为低分辨率的底图，在其上只叠加视口内的、与当前缩放比例相当级别的切片
+    showTiles: function() {
+      var t = data.tiles;
+      if (!t || !data.paper) {
+        return;
+      }
+      var s = data.ratio * data.ratioInitial;
+      var level = Math.max(0, Math.min(t.maxLevel, t.maxLevel - Math.floor(Math.log(1 / s) / Math.LN2)));
+      var size = t.tileSize * Math.pow(2, t.maxLevel - level);   // 一个切片在页面坐标中的宽高
+      var rc = data.paper.canvas.getBoundingClientRect();
+      var x1 = Math.max(0, -rc.left) / s, y1 = Math.max(0, -rc.top) / s;
+      var x2 = Math.min(data.width, Math.min(rc.width, window.innerWidth - rc.left) / s);
+      var y2 = Math.min(data.height, Math.min(rc.height, window.innerHeight - rc.top) / s);
+
+      if (t.level !== level) {
+        Object.keys(t.shown).forEach(function(key) {
+          t.shown[key].remove();
+        });
+        t.shown = {};
+        t.level = level;
+      }
+      for (var col = Math.floor(x1 / size); col * size < x2; col++) {
+        for (var row = Math.floor(y1 / size); row * size < y2; row++) {
+          var key = col + '_' + row;
+          if (!t.shown[key]) {
+            t.shown[key] = data.paper.image(t.url + '_files/' + level + '/' + key + '.jpg', col * size, row * size,
+              Math.min(size, data.width - col * size), Math.min(size, data.height - row * size))
+              .insertBefore(data.board);
+          }
+        }
+      }
+    },
+
     switchPage: function (name, pageData) {
       this.setRatio();
       state.hover = state.edit = null;
@@ -948,6 +990,7 @@
       ratio *= data.ratioInitial;
       data.paper.setZoom(ratio);
       data.paper.setSize(data.width * ratio, data.height * ratio);
+      this.showTiles();
 
       this.switchCurrentBox(el);
 
@@ -3,18 +3,34 @@
 # 导入页面文件到文档库，可导入页面图到 static/img 供本地调试用
 # 本脚本的执行结果相当于在“数据管理-实体页”中提供了图片、OCR切分数据、文本，是任务管理中发布切分和文字审校任务的前置条件。
 # python tests/add_pages.py --json_path=切分文件路径 [--img_path=页面图路径] [--txt_path=经文路径] [--kind=藏经类别码]
+#   [--workers=解析切分文件的进程数，默认为CPU数] [--batch_size=每批写入的页数]
+#   [--copy_workers=复制页面图的线程数] [--strict=True 时不导入切分框有问题的页面]
+#   [--manifest=导入清单文件，默认为 cache/import/库名.jsonl，重新运行时只导入新增或改变了的文件]
 
 from tornado.util import PY3
 from os import path, listdir, mkdir
+from multiprocessing import Pool
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import os
 import sys
 import json
+import hashlib
 import re
 import shutil
+import threading
+import time
 import pymongo
+from pymongo import UpdateOne
 from datetime import datetime
 
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+import model.user as u  # noqa: E402
+from model.box import check_boxes  # noqa: E402
+
 IMG_PATH = path.join(path.dirname(__file__), '..', 'static', 'img')
-data = dict(count=0)
+CACHE_PATH = path.join(path.dirname(__file__), '..', 'cache', 'import')
+data = dict(count=0, changed=0)
 
 
 def create_folder(filename):
@@ -26,92 +42,333 @@ def open_file(filename):
     return open(filename, encoding='UTF-8') if PY3 else open(filename)
 
 
-def load_json(filename):
-    if path.exists(filename):
-        try:
-            with open_file(filename) as f:
-                return json.load(f)
-        except Exception as e:
-            sys.stderr.write('invalid file %s: %s\n' % (filename, str(e)))
-
-
-def scan_dir(src_path, kind, db, ret):
+def scan_dir(src_path, kind, ret):
+    """ 查找切分文件，返回 [(页名, 文件名)]，同名的只取第一个 """
     if not path.exists(src_path):
         sys.stderr.write('%s not exist\n' % (src_path,))
         return []
+    files = []
     for fn in sorted(listdir(src_path)):
         filename = path.join(src_path, fn)
         if path.isdir(filename):
-            scan_dir(filename, fn if re.match(r'^[A-Z]{2}$', fn) else kind, db, ret)
-        elif kind and fn[:2] == kind:
-            if fn.endswith('.json') and fn[:-5] not in ret:
-                info = load_json(filename)
-                if info:
-                    name = info.get('imgname')
-                    if name != fn[:-5]:
-                        sys.stderr.write('invalid imgname %s, %s\n' % (filename, kind))
-                        continue
-                    add_page(name, info, db)
-                    ret.add(name)
-
-
-def add_page(name, info, db):
-    if not db.page.find_one(dict(name=name)):
-        meta = dict(name=name,
-                    kind=name[:2],
-                    width=int(info['imgsize']['width']),
-                    height=int(info['imgsize']['height']),
-                    blocks=info.get('blocks', []),
-                    columns=info.get('columns', []),
-                    chars=info.get('chars', []),
-                    txt='',
-                    create_time=datetime.now())
-        data['count'] += 1
-        print('%s:\t%d x %d blocks=%d columns=%d chars=%d' % (
-            name, meta['width'], meta['height'], len(meta['blocks']), len(meta['columns']), len(meta['chars'])))
-        db.page.insert_one(meta)
-
-
-def add_texts(src_path, pages, db):
+            files.extend(scan_dir(filename, fn if re.match(r'^[A-Z]{2}$', fn) else kind, ret))
+        elif kind and fn[:2] == kind and fn.endswith('.json') and fn[:-5] not in ret:
+            ret.add(fn[:-5])
+            files.append((fn[:-5], path.abspath(filename)))
+    return files
+
+
+class Manifest(object):
+    """
+    导入清单，每行记录一个已导入文件的路径、修改时间、大小和哈希。
+    每批数据写库后才追加这批文件的记录，中断后重新运行时从最后写入的一批之后继续，只处理新增或改变了的文件。
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        lines, partial = 0, ''
+        if path.exists(filename):
+            with open_file(filename) as f:
+                for line in f:
+                    lines += 1
+                    partial = '' if line.endswith('\n') else line
+                    try:
+                        r = json.loads(line)
+                        self.files[r['path']] = r
+                    except (ValueError, KeyError):  # 中断时最后一行可能不完整
+                        pass
+        if lines > len(self.files) * 2 + 1000:
+            self.compact()
+        elif partial:  # 去掉不完整的最后一行，以免之后追加的记录接在其后
+            with open(filename, 'rb+') as f:
+                f.truncate(path.getsize(filename) - len(partial.encode('UTF-8')))
+
+    def compact(self):
+        tmp_file = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_file, 'w', encoding='UTF-8') as f:
+            f.writelines(json.dumps(r) + '\n' for r in self.files.values())
+        os.replace(tmp_file, self.filename)
+
+    def get(self, filename):
+        """ 返回文件的导入记录，文件大小和修改时间都没变时返回 (记录, True) """
+        old = self.files.get(filename)
+        st = os.stat(filename)
+        return old, bool(old and old['size'] == st.st_size and old['mtime'] == st.st_mtime)
+
+    def commit(self, records):
+        if records:
+            with open(self.filename, 'a', encoding='UTF-8') as f:
+                f.writelines(json.dumps(r) + '\n' for r in records)
+                f.flush()
+                os.fsync(f.fileno())
+            self.files.update((r['path'], r) for r in records)
+
+
+def file_record(filename, content):
+    st = os.stat(filename)
+    return dict(path=filename, mtime=st.st_mtime, size=st.st_size, hash=hashlib.md5(content).hexdigest())
+
+
+def unpublished(types):
+    """ 这些任务都还没有发布的页面条件，只有这样的页面才用改变了的文件更新 """
+    return {'$and': [{t + '_status': None} for t in types]}
+
+
+def load_page(item, strict=False):
+    """
+    解析一个切分文件，在子进程中执行，返回 (页面文档, 导入记录)，内容没变或无效时页面文档为None。
+    输出切分框的几何问题，strict 为True时不导入有问题的页面
+    """
+    name, filename, old_hash = item
+    with open(filename, 'rb') as f:
+        content = f.read()
+    record = file_record(filename, content)
+    if record['hash'] == old_hash:
+        return None, record
+    try:
+        info = json.loads(content.decode('UTF-8'))
+    except ValueError as e:
+        sys.stderr.write('invalid file %s: %s\n' % (filename, str(e)))
+        return None, None
+    if info.get('imgname') != name:
+        sys.stderr.write('invalid imgname %s\n' % (filename,))
+        return None, None
+    meta = dict(name=name,
+                kind=name[:2],
+                width=int(info['imgsize']['width']),
+                height=int(info['imgsize']['height']),
+                blocks=info.get('blocks', []),
+                columns=info.get('columns', []),
+                chars=info.get('chars', []),
+                txt='',
+                version=1,
+                create_time=datetime.now())
+    problems = check_boxes(meta['width'], meta['height'], blocks=meta['blocks'], columns=meta['columns'],
+                           chars=meta['chars'])
+    for p in problems:
+        sys.stderr.write('%s: %s #%d %s %s\n' % (name, p['type'], p['index'] + 1, p['id'] or '', p['error']))
+    if problems and strict:
+        return None, None
+    return meta, record
+
+
+class PageBatch(object):
+    """ 一批待写库的新页面、待更新的页面和导入记录 """
+    CUT_TYPES = u.task_types[:6]  # 改变了的切分文件只更新这些任务都未发布的页面
+
+    def __init__(self, db, manifest, existing):
+        self.db, self.manifest, self.existing = db, manifest, existing
+        self.inserts, self.updates, self.records = [], [], []
+        self.updated = {}  # 待更新的页名: 文件路径
+
+    def add(self, name, meta, old_hash, filename):
+        if name not in self.existing:
+            self.inserts.append(meta)
+        elif old_hash:
+            boxes = dict((k, meta[k]) for k in ['width', 'height', 'blocks', 'columns', 'chars'])
+            self.updates.append(UpdateOne(dict(name=name, **unpublished(self.CUT_TYPES)),
+                                          {'$set': boxes, '$inc': {'version': 1}}))
+            self.updated[name] = filename
+
+    def flush(self):
+        if self.inserts:
+            self.db.page.insert_many(self.inserts, ordered=False)
+            data['count'] += len(self.inserts)
+        if self.updates:
+            matched = self.db.page.bulk_write(self.updates, ordered=False).matched_count
+            data['changed'] += matched
+            if matched < len(self.updates):
+                self.skip_published()
+        self.manifest.commit(self.records)
+        self.inserts, self.updates, self.records, self.updated = [], [], [], {}
+
+    def skip_published(self):
+        """ 已发布切分任务的页面未更新，不记其文件，以后重新运行时仍会提示 """
+        names = list(self.updated)
+        cond = dict(name={'$in': names}, **unpublished(self.CUT_TYPES))
+        updated = set(r['name'] for r in self.db.page.find(cond, {'name': 1, '_id': 0}))
+        skipped = [n for n in names if n not in updated]
+        files = set(self.updated[n] for n in skipped)
+        self.records = [r for r in self.records if r['path'] not in files]
+        print('%d changed pages not updated as their cut tasks are published: %s%s' % (
+            len(skipped), ', '.join(skipped[:10]), ' ...' if len(skipped) > 10 else ''))
+
+
+def add_pages(files, db, manifest, workers=0, batch_size=500, strict=False):
+    """
+    用进程池解析新增或改变了的切分文件，分批插入新页面，改变了的文件只更新还未发布切分任务的页面。
+    清单中没有记录但库中已有的页面不更新，只补记录。返回有效的页名集合
+    """
+    existing = set(r['name'] for r in db.page.find({}, {'name': 1, '_id': 0}))
+    pages, todo = set(existing), []
+    for name, filename in files:
+        old, same = manifest.get(filename)
+        if not same:
+            todo.append((name, filename, old['hash'] if old else None))
+
+    batch, start = PageBatch(db, manifest, existing), time.time()
+    with Pool(workers or None) as pool:
+        for i, (meta, record) in enumerate(pool.imap(partial(load_page, strict=strict), todo, chunksize=32)):
+            name, filename, old_hash = todo[i]
+            if record:
+                batch.records.append(record)
+            if meta:
+                pages.add(name)
+                batch.add(name, meta, old_hash, filename)
+            if len(batch.records) >= batch_size or i == len(todo) - 1:
+                batch.flush()
+                seconds = max(time.time() - start, 1e-3)
+                print('%d/%d files, %d new pages, %d changed, %.1fs, %.1f files/s' % (
+                    i + 1, len(todo), data['count'], data['changed'], seconds, (i + 1) / seconds))
+    return pages
+
+
+def scan_texts(src_path, pages, ret):
     if not path.exists(src_path):
-        return
+        return ret
     for fn in listdir(src_path):
         filename = path.join(src_path, fn)
         if path.isdir(filename):
-            add_texts(filename, pages, db)
+            scan_texts(filename, pages, ret)
         elif fn.endswith('.txt') and fn[:-4] in pages:
-            with open_file(filename) as f:
-                txt = f.read().strip().replace('\n', '|')
-            r = db.page.find_one(dict(name=fn[:-4]))
-            if r and not r.get('txt'):
-                db.page.update_one(dict(name=fn[:-4]), {'$set': {'txt': txt}})
+            ret.append((fn[:-4], path.abspath(filename)))
+    return ret
 
 
-def copy_img_files(src_path, pages):
+def add_texts(src_path, pages, db, manifest, batch_size=500):
+    """
+    为还没有文本的页面设置新增的文本，改变了的文本只更新还未发布文字任务的页面，分批更新。
+    未更新的页面(已有文本或已发布文字任务)不记其文件，以后重新运行时仍会提示
+    """
+    files, count, start = [], 0, time.time()
+    for name, filename in scan_texts(src_path, pages, []):
+        old, same = manifest.get(filename)
+        if not same:
+            files.append((name, filename, old))
+    for i in range(0, len(files), batch_size):
+        ops, records, texts = [], [], {}
+        for name, filename, old in files[i: i + batch_size]:
+            with open(filename, 'rb') as f:
+                content = f.read()
+            record = file_record(filename, content)
+            if old and old['hash'] == record['hash']:
+                records.append((None, record))
+                continue
+            cond = unpublished(u.task_types[6:]) if old else {'txt': {'$in': ['', None]}}
+            txt = texts[name] = content.decode('UTF-8').strip().replace('\n', '|')
+            ops.append(UpdateOne(dict(name=name, **cond), {'$set': {'txt': txt}, '$inc': {'version': 1}}))
+            records.append((name, record))
+        if ops:
+            matched = db.page.bulk_write(ops, ordered=False).matched_count
+            count += matched
+            if matched < len(ops):
+                records = skip_texts(db, records, texts)
+        manifest.commit([r for _, r in records])
+    if files:
+        print('%d/%d texts, %.1fs' % (count, len(files), time.time() - start))
+
+
+def skip_texts(db, records, texts):
+    """ 去掉未更新的文本文件的 (页名, 记录)，返回其余的 """
+    saved = set(r['name'] for r in db.page.find({'name': {'$in': list(texts)}}, {'name': 1, 'txt': 1, '_id': 0})
+                if r.get('txt') == texts[r['name']])
+    skipped = sorted(set(texts) - saved)
+    print('%d changed texts not updated as their pages have text or published text tasks: %s%s' % (
+        len(skipped), ', '.join(skipped[:10]), ' ...' if len(skipped) > 10 else ''))
+    return [(name, r) for name, r in records if name not in skipped]
+
+
+def scan_images(src_path, pages, ret, names=None):
+    names = set() if names is None else names
     if not path.exists(src_path):
-        return
-    create_folder(IMG_PATH)
-    for fn in listdir(src_path):
+        return ret
+    for fn in sorted(listdir(src_path)):
         filename = path.join(src_path, fn)
         if path.isdir(filename):
-            copy_img_files(filename, pages)
-        elif fn.endswith('.jpg') and fn[:-4] in pages:
-            dst_file = path.join(IMG_PATH, fn[:2])
-            create_folder(dst_file)
-            dst_file = path.join(dst_file, fn)
-            if not path.exists(dst_file):
-                shutil.copy(filename, dst_file)
+            scan_images(filename, pages, ret, names)
+        elif fn.endswith('.jpg') and fn[:-4] in pages and fn not in names:  # 同名的只取第一个
+            names.add(fn)
+            ret.append((filename, path.join(IMG_PATH, fn[:2], fn)))
+    return ret
+
+
+def file_hash(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def copy_image(src_file, dst_file):
+    """
+    复制一个页面图，同一文件系统上用硬链接。已有的目标文件与源文件大小不同、或修改时间不同且内容不同时重新复制。
+    返回 (方式, 字节数)，方式为 skip、link 或 copy
+    """
+    src = os.stat(src_file)
+    size = src.st_size
+    if path.exists(dst_file):
+        dst = os.stat(dst_file)
+        if dst.st_ino == src.st_ino and dst.st_dev == src.st_dev:
+            return 'skip', 0
+        if dst.st_size == size and (int(dst.st_mtime) == int(src.st_mtime)
+                                    or file_hash(dst_file) == file_hash(src_file)):
+            return 'skip', 0
+
+    tmp_file = '%s.%d.%d.tmp' % (dst_file, os.getpid(), threading.get_ident())
+    try:
+        os.link(src_file, tmp_file)
+        mode = 'link'
+    except OSError:  # 跨文件系统或不支持硬链接
+        shutil.copy2(src_file, tmp_file)
+        mode = 'copy'
+    if path.getsize(tmp_file) != size:
+        os.remove(tmp_file)
+        raise IOError('incomplete copy: %s' % src_file)
+    os.replace(tmp_file, dst_file)
+    return mode, size
+
+
+def copy_img_files(src_path, pages, workers=8):
+    """ 用线程池并行复制页面图到 static/img，输出复制速度 """
+    files = scan_images(src_path, pages, [])
+    if not files:
+        return
+    create_folder(IMG_PATH)
+    for folder in set(path.dirname(dst) for _, dst in files):
+        create_folder(folder)
+
+    counts, total, start = dict(skip=0, link=0, copy=0, error=0), 0, time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(copy_image, src, dst) for src, dst in files]
+        for (src, dst), future in zip(files, futures):
+            try:
+                mode, size = future.result()
+                counts[mode] += 1
+                total += size
+            except (IOError, OSError) as e:
+                counts['error'] += 1
+                sys.stderr.write('copy %s: %s\n' % (src, str(e)))
+    seconds = max(time.time() - start, 1e-3)
+    print('%d images: %d linked, %d copied, %d skipped, %d failed, %.1f MB in %.1fs, %.1f MB/s' % (
+        len(files), counts['link'], counts['copy'], counts['skip'], counts['error'],
+        total / 1048576, seconds, total / 1048576 / seconds))
 
 
-def main(json_path='', img_path='img', txt_path='txt', kind='', db_name='tripitaka', uri='localhost'):
+def main(json_path='', img_path='img', txt_path='txt', kind='', db_name='tripitaka', uri='localhost',
+         workers=0, batch_size=500, manifest='', copy_workers=8, strict=False):
     if not json_path:
         txt_path = json_path = img_path = path.join(path.dirname(__file__), 'data')
     conn = pymongo.MongoClient(uri)
     db = conn[db_name]
-    pages = set()
-    scan_dir(json_path, kind, db, pages)
-    copy_img_files(img_path, pages)
-    add_texts(txt_path, pages, db)
+    db.page.create_index('name')
+    create_folder(path.dirname(CACHE_PATH))
+    create_folder(CACHE_PATH)
+    manifest = Manifest(manifest or path.join(CACHE_PATH, db_name + '.jsonl'))
+    pages = add_pages(scan_dir(json_path, kind, set()), db, manifest, workers, batch_size, strict)
+    copy_img_files(img_path, pages, copy_workers)
+    add_texts(txt_path, pages, db, manifest, batch_size)
     return data['count']
 
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 每个请求都要执行的公共函数的性能测试：convert_bson、convert2obj、fetch2obj、convert_for_send、get_body_obj、gen_id，
+# 分别用小、中、大的数据测试：列表类的转换按1条、50条、1000条记录(每页条数的上限)批量调用，
+# 提交的切分框为1个用户、一页(数百字)、十页合并(数千字)。取多轮的中位数与保存的基准比较，变慢超过阈值时以状态码1退出。
+# python tests/benchmark/helpers.py [--save=True 保存为新的基准] [--threshold=允许变慢的比例，默认0.2]
+#   [--baseline=基准文件，默认为 cache/benchmark/helpers.json] [--only=只测名称含此串的项]
+
+from os import path
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from tornado.escape import json_encode
+from tornado.httputil import HTTPServerRequest
+
+BASE_DIR = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+import model.user as u  # noqa: E402
+from controller import errors  # noqa: E402
+from controller.base import BaseHandler, convert_bson, convert2obj, fetch_authority  # noqa: E402
+from controller.api.task.task import SaveTask  # noqa: E402
+from tests.benchmark.load import make_page  # noqa: E402
+
+MIN_SECONDS = 0.2  # 每轮计时的最短秒数，据此确定每轮的调用次数
+REPEAT = 9  # 取各轮的中位数，不受个别轮次中其他进程干扰的影响
+COUNTS = dict(small=1, typical=50, huge=1000)  # 批量调用的记录数
+
+
+def make_fixtures():
+    """ 生成小、中、大三种切分数据：用户记录，一页(数百字)，十页合并(数千字) """
+    rnd = random.Random(1)
+    pages = [make_page('BM_1_%d' % (i + 1), rnd) for i in range(10)]
+    huge = dict(pages[0], name='BM_1_0', txt='\n'.join(p['txt'] for p in pages),
+                **{k: sum([p[k] for p in pages], []) for k in ['blocks', 'columns', 'chars']})
+    docs = dict(small=make_user(0), typical=pages[0], huge=huge)
+    for doc in docs.values():
+        doc['_id'] = '5c8a1d5b0d8a4e2b8c4e6f01'
+    return docs
+
+
+def make_user(i):
+    email = 'bench%d@test.com' % i
+    return dict(id=errors.gen_id(email, 'user'), name='测试用户', email=email, password=errors.gen_id('bench123'),
+                phone=13600000000 + i, gender='女', create_time=errors.get_date_time(), last_time=datetime.now(),
+                **{k: i % 2 for k in u.authority_map})
+
+
+def make_task_page(i, rnd):
+    """ 任务列表中的一条页面记录(不含切分框)：各任务类型的状态、领取人和起止时间，时间为 datetime 须由 convert_bson 转换 """
+    page = dict(_id='5c8a1d5b0d8a4e2b8c4e%04x' % i, name='BM_%d_%d' % (i // 100 + 1, i % 100 + 1), kind='BM',
+                version=rnd.randint(1, 20), create_time=datetime.now())
+    for t in u.task_types:
+        status = rnd.choice(list(u.task_statuses))
+        if status:
+            page.update({t + '_status': status, t + '_priority': rnd.choice(['高', '中', '低'])})
+        if status in [u.STATUS_LOCKED, u.STATUS_ENDED]:
+            start = datetime.now() - timedelta(hours=rnd.randint(1, 100))
+            page.update({t + '_user': errors.gen_id('bench%d@test.com' % rnd.randint(0, 99), 'user'),
+                         t + '_nickname': '测试用户', t + '_start_time': start})
+        if status == u.STATUS_ENDED:
+            page[t + '_end_time'] = page[t + '_start_time'] + timedelta(minutes=rnd.randint(5, 60))
+    return page
+
+
+def convert_bson_all(docs):
+    return [convert_bson(d) for d in docs]
+
+
+def convert2obj_all(cls, objs):
+    return [convert2obj(cls, obj) for obj in objs]
+
+
+def fetch2obj_all(records, cls, extra):
+    return [BaseHandler.fetch2obj(r, cls, extra) for r in records]
+
+
+def make_handler(body):
+    """ 只有请求体的响应对象，足够调用 get_body_obj 和 convert_for_send """
+    handler = BaseHandler.__new__(BaseHandler)
+    handler.request = HTTPServerRequest(method='POST', uri='/api', body=body.encode('utf-8'))
+    return handler
+
+
+def make_cases(docs):
+    """
+    返回 {名称: (函数, 生成参数的函数)}，会修改参数的函数每次调用用新的副本。
+    各函数的数据与实际调用时相似：任务列表的页面记录用于 convert_bson，用户注册或修改的内容用于 convert2obj，
+    用户记录和用户列表用于 fetch2obj 和 convert_for_send，都按列表的条数批量调用；提交的切分框用于 get_body_obj
+    """
+    cases = {}
+    rnd = random.Random(1)
+    for size, doc in docs.items():
+        count = COUNTS[size]
+        pages = [make_task_page(i, rnd) for i in range(count)]
+        records = [make_user(i) for i in range(count)]
+        objs = [dict(r, last_time=errors.get_date_time()) for r in records]  # 请求中的时间为字符串
+        users = [BaseHandler.fetch2obj(r, u.User, fetch_authority) for r in records]
+        if size == 'small':
+            body = dict(email=records[0]['email'], password='bench123')
+            cls = u.User
+        else:
+            body = dict(name=doc['name'], submit=1, boxes=json_encode(doc['blocks'] + doc['columns'] + doc['chars']))
+            cls = SaveTask
+        handler = make_handler(json_encode(dict(data=json_encode(body))))
+        value = dict(small='bench123', typical=records[0]['email'], huge=u.ACCESS_MANAGER * 20)[size]
+
+        cases['convert_bson/' + size] = (convert_bson_all, lambda d=pages: ([dict(p) for p in d],))
+        cases['convert2obj/' + size] = (convert2obj_all, lambda o=objs: (u.User, [dict(r) for r in o]))
+        cases['fetch2obj/' + size] = (fetch2obj_all, lambda r=records: (r, u.User, fetch_authority))
+        cases['convert_for_send/' + size] = (handler.convert_for_send, lambda o=users: (o,))
+        cases['get_body_obj/' + size] = (handler.get_body_obj, lambda c=cls: (c,))
+        cases['gen_id/' + size] = (errors.gen_id, lambda v=value: (v,))
+    return cases
+
+
+def measure(func, make_args):
+    """ 返回每次调用的微秒数，取各轮的中位数 """
+    args = make_args()
+    start = time.perf_counter()
+    func(*args)
+    number = max(1, min(100000, int(MIN_SECONDS / max(time.perf_counter() - start, 1e-7))))
+    rounds = []
+    for _ in range(REPEAT):
+        items = [make_args() for _ in range(number)]
+        start = time.perf_counter()
+        for args in items:
+            func(*args)
+        rounds.append(time.perf_counter() - start)
+    return statistics.median(rounds) * 1e6 / number
+
+
+def run(save=False, threshold=0.2, baseline='', only=''):
+    baseline = baseline or path.join(BASE_DIR, 'cache', 'benchmark', 'helpers.json')
+    old = {}
+    if path.exists(baseline):
+        with open(baseline) as f:
+            old = json.load(f).get('results', {})
+
+    results, regressions = {}, []
+    for name, (func, make_args) in sorted(make_cases(make_fixtures()).items()):
+        if only and only not in name:
+            continue
+        us = results[name] = round(measure(func, make_args), 3)
+        change = '%+6.1f%%' % (100.0 * (us - old[name]) / old[name]) if old.get(name) else ''
+        if old.get(name) and us > old[name] * (1 + threshold):
+            regressions.append(name)
+            change += '  SLOWER'
+        print('%-26s %10.2f us  %s' % (name, us, change))
+
+    if save:
+        if not path.exists(path.dirname(baseline)):
+            os.makedirs(path.dirname(baseline))
+        with open(baseline, 'w') as f:
+            json.dump(dict(time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                           machine=platform.node(), results=dict(old, **results)), f, indent=2, sort_keys=True)
+        print('saved to %s' % baseline)
+    elif regressions:
+        print('%d items slower than the baseline by more than %d%%: %s' % (
+            len(regressions), threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
+    elif not old:
+        print('no baseline, run with --save=True to create %s' % baseline)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(run)
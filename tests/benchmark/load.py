@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 端到端压力测试：在测试库中生成合成的藏经页面(BM藏)，通过注册接口创建用户并发布切栏校对任务，
+# 各用户并发执行“任务大厅-进入任务(领取)-取切分框-保存-提交”循环，输出各接口的吞吐量和延迟分位数。
+# python tests/benchmark/load.py run [--pages=页数] [--users=并发用户数] [--rounds=每个用户的循环次数]
+#   [--processes=服务进程数] [--url=已启动的服务地址，为空时自动以测试库启动服务] [--report=结果文件.json]
+#   [--compare=以前的结果文件.json，输出各接口的变化]
+# python tests/benchmark/load.py serve [--port=端口] [--processes=进程数]  以测试库启动服务
+# python tests/benchmark/load.py corpus [--pages=页数]  只生成合成页面
+
+from os import path
+from http.cookies import SimpleCookie
+import json
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import pymongo
+from datetime import datetime
+from tornado import gen, ioloop
+from tornado.escape import json_decode, json_encode
+from tornado.httpclient import AsyncHTTPClient
+
+sys.path.append(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))))
+import model.user as u  # noqa: E402
+
+KIND = 'BM'
+XSRF = 'b1e7c0a9f3d24e6a8c5b7d9e1f2a3b4c'  # 客户端自定的 _xsrf 令牌，与 Cookie 一致即可
+ADMIN = dict(email='admin@test.com', name='管理', password='test123')
+TEXT = ('如是我聞一時佛在舍衛國祇樹給孤獨園與大比丘眾千二百五十人俱爾時世尊食時著衣持鉢入舍衛大城乞食於其城中次第乞已'
+        '還至本處飯食訖收衣鉢洗足已敷座而坐時長老須菩提在大眾中即從座起偏袒右肩右膝著地合掌恭敬而白佛言希有世尊')
+
+
+def make_page(name, rnd):
+    """ 生成一个合成页面：上下排列的1~2栏，每栏自右向左10~18列，每列12~20字，文本与字框一致 """
+    width, height = 2500, 3400
+    blocks, columns, chars, lines = [], [], [], []
+    block_count = rnd.randint(1, 2)
+    block_h = (height - 400) // block_count
+    for b in range(1, block_count + 1):
+        bx, by, bw, bh = 300, 200 + (b - 1) * block_h, width - 600, block_h - 40
+        blocks.append(dict(x=bx, y=by, w=bw, h=bh, no=b, block_id='b%d' % b, cc=1))
+        col_count = rnd.randint(10, 18)
+        col_w = bw // col_count
+        for c in range(1, col_count + 1):
+            cx = bx + bw - c * col_w
+            char_count = rnd.randint(12, 20)
+            char_h = bh // char_count
+            txt = ''.join(rnd.choice(TEXT) for _ in range(char_count))
+            column_id = 'b%dc%d' % (b, c)
+            columns.append(dict(x=cx + 2, y=by + 2, w=col_w - 4, h=bh - 4, no=c, column_id=column_id,
+                                block_no=b, line_no=c, txt=txt, cc=1))
+            for i in range(1, char_count + 1):
+                chars.append(dict(x=cx + 6, y=by + (i - 1) * char_h + 6, w=col_w - 12, h=char_h - 12,
+                                  no=i, char_id='%sc%d' % (column_id, i), block_no=b, line_no=c, char_no=i,
+                                  txt=txt[i - 1], cc=round(rnd.uniform(0.5, 1), 4)))
+            lines.append(txt)
+        lines.append('')
+    return dict(name=name, kind=KIND, width=width, height=height, blocks=blocks, columns=columns, chars=chars,
+                txt='\n'.join(lines).strip(), version=1, create_time=datetime.now())
+
+
+def corpus(pages=500, db_name='tripitaka_test', uri='localhost', seed=1):
+    """ 在测试库中重新生成合成页面，返回页数 """
+    db = pymongo.MongoClient(uri)[db_name]
+    db.page.delete_many(dict(kind=KIND))
+    rnd = random.Random(seed)
+    items = [make_page('%s_%d_%d' % (KIND, i // 100 + 1, i % 100 + 1), rnd) for i in range(pages)]
+    for i in range(0, len(items), 500):
+        db.page.insert_many(items[i: i + 500], ordered=False)
+    chars = sum(len(p['chars']) for p in items)
+    print('%d pages, %.0f chars per page' % (pages, chars / max(pages, 1)))
+    return pages
+
+
+def serve(port=8001, processes=2):
+    """ 以测试库(与单元测试相同)启动多进程服务，与 main.py 一样预加载后派生工作进程 """
+    from tornado.httpserver import HTTPServer
+    from tornado.options import options
+    import controller as c
+    from controller.app import Application
+    from controller.master import Master, listen
+
+    options.debug, options.port = False, port
+    app = Application(c.handlers, db_name_ext='_test', default_handler_class=c.InvalidPageHandler,
+                      ui_modules=c.modules, xsrf_cookies=True)
+    server = HTTPServer(app, xheaders=True)
+    sockets = listen(port)
+    master = Master(sockets, processes)
+    app.preload()
+    app.metrics.worker = master.fork_processes()
+    server.add_sockets(sockets)
+    master.notify_ready()
+    ioloop.IOLoop.current().start()
+
+
+class Stats(object):
+    """ 各接口的耗时和出错次数 """
+
+    def __init__(self):
+        self.times, self.errors = {}, {}
+
+    def add(self, endpoint, seconds, ok):
+        self.times.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, seconds):
+        result = {}
+        for endpoint, times in self.times.items():
+            times = sorted(times)
+
+            def pick(q):
+                return round(1000 * times[min(len(times) - 1, int(q * len(times)))], 1)
+
+            result[endpoint] = dict(count=len(times), errors=self.errors.get(endpoint, 0),
+                                    rps=round(len(times) / seconds, 1), mean=round(1000 * sum(times) / len(times), 1),
+                                    p50=pick(0.5), p90=pick(0.9), p99=pick(0.99), max=round(1000 * times[-1], 1))
+        return result
+
+
+class Session(object):
+    """ 一个用户的会话，自行保存 Cookie 并带上 _xsrf 令牌 """
+
+    def __init__(self, client, base_url, stats):
+        self.client, self.base_url, self.stats = client, base_url, stats
+        self.cookies = dict(_xsrf=XSRF)
+
+    @gen.coroutine
+    def fetch(self, endpoint, url, data=None):
+        headers = {'Cookie': '; '.join('%s=%s' % kv for kv in self.cookies.items()),
+                   'X-Xsrftoken': self.cookies['_xsrf']}
+        body = None if data is None else json_encode(dict(data=json_encode(data)))  # 与网页和 APITestCase 一样
+        start = time.time()
+        r = yield self.client.fetch(self.base_url + url, method='GET' if body is None else 'POST', body=body,
+                                    headers=headers, raise_error=False, follow_redirects=False,
+                                    request_timeout=60)
+        seconds = time.time() - start
+        for text in r.headers.get_list('Set-Cookie'):
+            for k, morsel in SimpleCookie(text).items():
+                self.cookies[k] = morsel.coded_value
+        result = r.body.decode('utf-8') if r.body else ''
+        if result.startswith('{'):
+            result = json_decode(result)
+        ok = r.code < 400 and not (isinstance(result, dict) and result.get('error'))
+        self.stats.add(endpoint, seconds, ok)
+        return result if ok else None
+
+
+@gen.coroutine
+def setup_users(client, base_url, stats, count):
+    """ 与 APITestCase.add_users 一样通过接口注册用户，由管理员授予切分校对权限，返回已登录的会话 """
+    admin = Session(client, base_url, stats)
+    yield admin.fetch('register', '/api/user/register', ADMIN)
+    if not (yield admin.fetch('login', '/api/user/login', dict(email=ADMIN['email'], password=ADMIN['password']))):
+        raise RuntimeError('cannot login as %s' % ADMIN['email'])
+
+    sessions = []
+    for i in range(count):
+        s = Session(client, base_url, stats)
+        user = dict(email='bench%d@test.com' % i, name='Bench ' + ''.join('abcdefghij'[int(d)] for d in str(i)),
+                    password='bench%d1' % i)
+        yield s.fetch('register', '/api/user/register', user)
+        yield admin.fetch('change', '/api/user/change', dict(email=user['email'], authority=u.ACCESS_CUT_PROOF))
+        if not (yield s.fetch('login', '/api/user/login', dict(email=user['email'], password=user['password']))):
+            raise RuntimeError('cannot login as %s' % user['email'])
+        sessions.append(s)
+
+    r = yield admin.fetch('start', '/api/start/' + KIND, dict(types='block_cut_proof', priority='高'))
+    if not r:
+        raise RuntimeError('cannot publish tasks, %s may not be a manager' % ADMIN['email'])
+    return sessions
+
+
+@gen.coroutine
+def work(s, rounds, rnd):
+    """ 一个用户的循环：任务大厅、随机进入一个任务(领取)、取切分框、保存、提交。各用户随机选页，以免都争抢第一页 """
+    for _ in range(rounds):
+        html = yield s.fetch('hall', '/dzj_cut.html')
+        names = re.findall(r'href="/dzj_block_cut_proof/(%s_\w+)"' % KIND, html or '')
+        if not names:
+            break
+        name = rnd.choice(names)
+        yield s.fetch('detail', '/dzj_block_cut_proof/' + name)
+        r = yield s.fetch('boxes', '/api/page/%s/blocks' % name)
+        boxes = json_encode(r['boxes'] if r else [])
+        yield s.fetch('save', '/api/save/block_cut_proof', dict(name=name, boxes=boxes))
+        yield s.fetch('submit', '/api/save/block_cut_proof', dict(name=name, boxes=boxes, submit=1))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except (IOError, OSError):
+            time.sleep(0.2)
+
+
+def print_report(result, old=None):
+    print('%-10s %7s %6s %8s %8s %8s %8s %8s %8s' % (
+        'endpoint', 'count', 'errors', 'rps', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for endpoint, r in sorted(result['endpoints'].items()):
+        line = '%-10s %7d %6d %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+            endpoint, r['count'], r['errors'], r['rps'], r['mean'], r['p50'], r['p90'], r['p99'], r['max'])
+        o = old and old['endpoints'].get(endpoint)
+        if o:
+            line += '  p50 %+.0f%% p99 %+.0f%%' % (
+                100.0 * (r['p50'] - o['p50']) / max(o['p50'], 0.1), 100.0 * (r['p99'] - o['p99']) / max(o['p99'], 0.1))
+        print(line)
+    print('%d rounds in %.1fs, %.1f rounds/s' % (result['rounds'], result['seconds'], result['rounds_per_second']))
+
+
+def run(pages=500, users=20, rounds=10, processes=2, url='', db_name='tripitaka_test', uri='localhost',
+        report='', compare=''):
+    """ 生成页面和用户后并发压测，url 为空时以测试库启动服务并在结束后停止 """
+    corpus(pages, db_name, uri)
+    db = pymongo.MongoClient(uri)[db_name]
+    db.user.delete_many(dict(email=re.compile(r'^bench\d+@test\.com$')))
+
+    server = None
+    if not url:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, path.abspath(__file__), 'serve', '--port=%d' % port,
+                                   '--processes=%d' % processes])
+        url = 'http://127.0.0.1:%d' % port
+        if not wait_ready(port):
+            server.terminate()
+            raise RuntimeError('server not ready')
+
+    @gen.coroutine
+    def main():
+        client = AsyncHTTPClient(force_instance=True, max_clients=users)
+        setup = Stats()
+        sessions = yield setup_users(client, url, setup, users)
+        stats, start = Stats(), time.time()
+        for s in sessions:
+            s.stats = stats
+        yield [work(s, rounds, random.Random(i)) for i, s in enumerate(sessions)]  # 固定种子，各次运行可比
+        seconds = time.time() - start
+        client.close()
+        return dict(time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), pages=pages, users=users,
+                    processes=processes, seconds=round(seconds, 2), rounds=len(stats.times.get('submit', [])),
+                    rounds_per_second=round(len(stats.times.get('submit', [])) / seconds, 1),
+                    endpoints=stats.report(seconds), setup=setup.report(seconds))
+
+    try:
+        result = ioloop.IOLoop.current().run_sync(main)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    old = None
+    if compare:
+        with open(compare) as f:
+            old = json.load(f)
+    print_report(result, old)
+    if report:
+        with open(report, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(dict(run=run, serve=serve, corpus=corpus))
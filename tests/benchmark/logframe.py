@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 比较日志查找调用位置的开销：logging 默认方式、原来按正则逐帧匹配的方式、按代码对象缓存的方式
+# python tests/benchmark/logframe.py [--count=调用次数]
+
+from os import path
+import io
+import logging
+import re
+import sys
+import timeit
+
+sys.path.append(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))))
+from controller import logframe  # noqa: E402
+
+# 模拟 base.py 中记日志的公共函数，日志应记录调用它的位置
+base_code = compile('import logging\ndef add_op_log(op):\n    logging.info(op)\n', 'controller/base.py', 'exec')
+base = {}
+exec(base_code, base)
+
+
+def regex_framer():
+    """ 原来的 my_framer：每条日志都逐帧做正则匹配 """
+    f0 = f = sys._getframe(1)
+    while f is not None and re.search(r'(web|base)\.py|logging', f.f_code.co_filename):
+        f0, f = f, f.f_back
+    return f0
+
+
+def caller():
+    base['add_op_log']('login')
+
+
+def run(count=100000):
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(filename)s:%(funcName)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers, root.level = [handler], logging.INFO
+
+    for name, framer in [('default', logframe._old_framer), ('regex', regex_framer),
+                         ('cached', logframe.find_caller_frame)]:
+        logging.currentframe = framer
+        stream.seek(0)
+        stream.truncate()
+        caller()
+        where = stream.getvalue().split()[0]
+        seconds = min(timeit.repeat(caller, number=count, repeat=3))
+        print('%-8s %6.2f us/call  %s' % (name, seconds * 1e6 / count, where))
+    logframe.install()
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(run)
@@ -3,8 +3,10 @@
 """
 @time: 2018/12/27
 """
+from tornado.escape import json_encode
 from tests.testcase import APITestCase
 import controller.errors as e
+import re
 import model.user as u
 
 user1 = 'text1@test.com', 't12345'
@@ -114,6 +116,29 @@ class TestTextTask(APITestCase):
         self.assert_code(200, r)
         page = self.parse_response(r)['page']
         self.assertEqual(page['name'], name)
+        self.assertNotIn('chars', page)
+
+        # 切分框数据另由接口获取，带当前版本号时可长期缓存
+        r = self.fetch('/api/page/%s/chars?v=%d' % (name, page.get('version', 0)))
+        boxes = self.parse_response(r).get('boxes')
+        self.assertIsInstance(boxes, list)
+        self.assertIn('max-age', r.headers.get('Cache-Control'))
+
+        # 保存切分框时检查几何有效性
+        bad = boxes + [dict(x=-100, y=0, w=10, h=10, char_id='bad')]
+        r = self.fetch('/api/save/char_cut_proof', body={'data': dict(name=name, boxes=json_encode(bad))})
+        self.assert_code(e.invalid_box, r)
+        for bad in ['[{"x": 1', json_encode([1, 2]), json_encode(dict(x=1))]:
+            r = self.fetch('/api/save/char_cut_proof', body={'data': dict(name=name, boxes=bad)})
+            self.assert_code(e.invalid_parameter, r)
+        # 只保存框的位置，ID、序号等沿用原有框，前端附加的字段不保存
+        sent = [dict(b, block_no=99, shape='x', changed=True) for b in boxes]
+        r = self.parse_response(self.fetch('/api/save/char_cut_proof',
+                                           body={'data': dict(name=name, boxes=json_encode(sent))}))
+        self.assertTrue(r.get('saved'))
+        self.assertIsInstance(r.get('problems'), list)
+        r = self.fetch('/api/page/%s/chars' % name)
+        self.assertEqual(self.parse_response(r).get('boxes'), boxes)
 
         # 任务提交后自动流转到下一校次
         page = self.parse_response(self.fetch('/api/page/%s?_raw=1' % name))
@@ -153,6 +178,25 @@ class TestTextTask(APITestCase):
         r = self.parse_response(self.fetch('/api/pages/cut_status'))
         self.assertEqual(r['items'][0].get('char_cut_proof_status'), u.STATUS_OPENED)
 
+        # 状态页面列表分页返回，并有按藏别和册别汇总的状态页数
+        r = self.parse_response(self.fetch('/api/pages/cut_status?page_size=1'))
+        self.assertEqual(len(r['items']), 1)
+        self.assertEqual(r['total'], len(names))
+        volumes = [s for kind_stats in r['stats'].values() for s in kind_stats.values()]
+        self.assertEqual(sum(s['char_cut_proof'].get(u.STATUS_OPENED, 0) for s in volumes), len(names))
+        self.assertEqual(set(r['stats'].get('GL', {})), set(re.sub(r'^(GL_[^_]+).*', r'\1', n) for n in names
+                                                            if n.startswith('GL_')))
+        for bad in ['page=x', 'page_size=1.5', 'prefix=a.*']:
+            self.assert_code(e.invalid_parameter, self.fetch('/api/pages/cut_status?' + bad))
+
+        # 页码链接保留藏别前缀和每页条数
+        r = self.parse_response(self.fetch('/dzj_task_cut_status.html?prefix=GL&page_size=1'))
+        self.assertIn('?prefix=GL&amp;page_size=1&amp;page=1', r)
+
+        # 切分状态页面在进程内调用API取页面列表
+        r = self.parse_response(self.fetch('/dzj_task_cut_status.html?_raw=1'))
+        self.assertEqual(r['items'][0].get('char_cut_proof_status'), u.STATUS_OPENED)
+
         # 因为还有其他任务类型，所以得到的页名没少
         r = self.parse_response(self.fetch('/api/pages/cut_start', body={}))
         self.assertEqual(len(r['items']), len(names))
@@ -182,3 +226,23 @@ class TestTextTask(APITestCase):
         r = self.parse_response(self.start_tasks('column_cut_proof'))
         self.assertEqual(len(names), len(r['names']))
         self.assertEqual(r['items'][0].get('status'), u.STATUS_PENDING)
+
+    def test_page_etag(self):
+        """ 测试页面数据未改变时回复304，改变后ETag也改变 """
+
+        self.login_as_admin()
+        name = self.parse_response(self.start_tasks('block_cut_proof'))['names'][0]
+        r = self.fetch('/api/page/' + name)
+        etag = r.headers.get('Etag')
+        self.assertTrue(etag)
+        self.assert_code(304, self.fetch('/api/page/' + name, headers={'If-None-Match': etag}))
+
+        # 退回任务后页面版本号增加
+        self.fetch('/api/unlock/block_cut_proof/')
+        r = self.fetch('/api/page/' + name, headers={'If-None-Match': etag})
+        self.assert_code(200, r)
+        self.assertNotEqual(etag, r.headers.get('Etag'))
+
+        # 页面列表也可按ETag回复304
+        r = self.fetch('/api/pages/cut_status')
+        self.assert_code(304, self.fetch('/api/pages/cut_status', headers={'If-None-Match': r.headers['Etag']}))
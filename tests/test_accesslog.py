@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/18
+"""
+from os import path
+from types import SimpleNamespace
+from unittest import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from controller.accesslog import AccessLog
+
+
+class NormalHandler(object):
+    """ 只有访问日志所需属性的响应对象 """
+    ACCESS_LOG = 'normal'
+
+    def __init__(self, status=200, user=None, uri='/api/test'):
+        self.status = status
+        self._current_user = user and SimpleNamespace(name=user)
+        self.request = SimpleNamespace(method='GET', uri=uri, remote_ip='127.0.0.1', request_time=lambda: 0.0123)
+
+    def get_status(self):
+        return self.status
+
+
+class QuietHandler(NormalHandler):
+    ACCESS_LOG = 'quiet'
+
+
+class TestAccessLog(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = path.join(self.path, 'access.log')
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:  # 停止写出线程，丢弃只用于检查的缓冲记录
+            log.buffer.clear()
+            log.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def make_log(self, filename=None, sample=None, thread=False):
+        """ 生成访问日志，thread 为 False 时将其视为本进程已启动写出线程，记录只留在缓冲区中 """
+        log = AccessLog(filename, sample)
+        if not thread:
+            log.pid = os.getpid()
+        self.logs.append(log)
+        return log
+
+    def read_lines(self):
+        with open(self.filename, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_sample(self):
+        """ 测试成功的请求按响应类的比例采样，出错的都记录，404按 quiet 的比例采样 """
+        log = self.make_log(sample=dict(quiet=0))
+        for status in [200, 302, 404]:
+            log.log(QuietHandler(status))
+        self.assertEqual(len(log.buffer), 0)
+        for status in [400, 403, 500]:
+            log.log(QuietHandler(status))
+        log.log(NormalHandler(200))
+        log.log(NormalHandler(404))
+        self.assertEqual([item[1] for item in log.buffer], [400, 403, 500, 200])
+        self.assertEqual(log.rates, {QuietHandler: 0.0, NormalHandler: 1.0})
+
+        log = self.make_log(sample=dict(quiet=0.25))
+        random.seed(1)
+        for i in range(2000):
+            log.log(QuietHandler())
+        self.assertTrue(400 < len(log.buffer) < 600, len(log.buffer))
+        self.assertEqual(log.buffer[0][-1], 0.25)  # 记下采样比例，以便统计时还原
+
+    def test_flush_thread(self):
+        """ 测试后台线程定期写出JSON行，关闭时写出剩余的记录 """
+        log = self.make_log(self.filename, thread=True)
+        log.FLUSH_INTERVAL = 0.05
+        try:
+            log.log(NormalHandler(200, user='张三'))
+            log.log(NormalHandler(500, uri='/api/error'))
+            self.assertIsNotNone(log.thread)
+            for i in range(40):
+                if path.exists(self.filename) and len(self.read_lines()) == 2:
+                    break
+                time.sleep(0.05)
+            lines = self.read_lines()
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0]['user'], '张三')
+            self.assertEqual(lines[0]['ms'], 12.3)
+            self.assertEqual(lines[1]['status'], 500)
+            self.assertNotIn('user', lines[1])
+            self.assertEqual(set(lines[1]), set(AccessLog.FIELDS) - {'user'})
+            log.log(NormalHandler(201))  # 由 close 等线程写出
+        finally:
+            log.close()
+        self.assertIsNone(log.thread)
+        self.assertEqual([r['status'] for r in self.read_lines()], [200, 500, 201])
+
+    def test_logger(self):
+        """ 测试未指定文件时按状态码以不同级别输出到 tornado.access 日志 """
+        log = self.make_log()
+        for status in [200, 403, 500]:
+            log.log(NormalHandler(status))
+        with self.assertLogs('tornado.access', level='INFO') as logs:
+            log.flush()
+        self.assertEqual([r.levelname for r in logs.records], ['INFO', 'WARNING', 'ERROR'])
+        self.assertEqual(json.loads(logs.records[0].getMessage())['uri'], '/api/test')
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/19
+"""
+from os import path
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+from tests import add_pages
+
+
+class TestAddPages(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.manifest_file = path.join(self.path, 'manifest.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write(self, name, content):
+        filename = path.join(self.path, name)
+        if not path.exists(path.dirname(filename)):
+            os.makedirs(path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+    def record(self, filename):
+        with open(filename, 'rb') as f:
+            return add_pages.file_record(filename, f.read())
+
+    def test_manifest(self):
+        """ 测试导入清单记录文件的大小和修改时间，文件改变后需重新导入 """
+        files = [self.write('GL_1_%d.json' % i, b'{}') for i in range(3)]
+        manifest = add_pages.Manifest(self.manifest_file)
+        self.assertEqual(manifest.get(files[0]), (None, False))
+        manifest.commit([self.record(fn) for fn in files])
+
+        manifest = add_pages.Manifest(self.manifest_file)
+        for fn in files:
+            self.assertTrue(manifest.get(fn)[1])
+        os.utime(files[1], (time.time() + 10, time.time() + 10))
+        self.write('GL_1_2.json', b'{"a": 1}')
+        self.assertEqual([manifest.get(fn)[1] for fn in files], [True, False, False])
+        self.assertEqual(manifest.get(files[2])[0]['hash'], self.record(files[0])['hash'])  # 旧记录的哈希
+
+    def test_resume(self):
+        """ 测试中断后重新运行时跳过已提交的一批，忽略中断时未写完的最后一行 """
+        files = [self.write('GL_1_%d.json' % i, b'{}') for i in range(4)]
+        manifest = add_pages.Manifest(self.manifest_file)
+        manifest.commit([self.record(fn) for fn in files[:2]])
+        with open(self.manifest_file, 'a') as f:
+            f.write(json.dumps(self.record(files[2]))[:20])
+
+        manifest = add_pages.Manifest(self.manifest_file)
+        self.assertEqual([manifest.get(fn)[1] for fn in files], [True, True, False, False])
+        manifest.commit([self.record(fn) for fn in files[2:]])  # 不完整的行之后仍可追加
+        manifest = add_pages.Manifest(self.manifest_file)
+        self.assertEqual([manifest.get(fn)[1] for fn in files], [True] * 4)
+
+    def test_compact(self):
+        """ 测试清单中重复的记录过多时重写为每个文件一行 """
+        filename = self.write('GL_1_1.json', b'{}')
+        manifest = add_pages.Manifest(self.manifest_file)
+        for i in range(1010):
+            manifest.commit([self.record(filename)])
+        manifest = add_pages.Manifest(self.manifest_file)
+        with open(self.manifest_file) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertTrue(manifest.get(filename)[1])
+
+    def test_copy_image(self):
+        """ 测试复制页面图：首次链接或复制，未改变的跳过，改变了的重新复制 """
+        src = self.write('src/GL_1_1.jpg', b'1' * 100)
+        dst = path.join(self.path, 'dst', 'GL_1_1.jpg')
+        os.makedirs(path.dirname(dst))
+        mode, size = add_pages.copy_image(src, dst)
+        self.assertIn(mode, ['link', 'copy'])
+        self.assertEqual(size, 100)
+        self.assertEqual(add_pages.copy_image(src, dst), ('skip', 0))
+
+        os.remove(src)  # 断开硬链接后写入新内容
+        self.write('src/GL_1_1.jpg', b'2' * 120)
+        self.assertEqual(add_pages.copy_image(src, dst)[1], 120)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'2' * 120)
+        self.assertEqual([fn for fn in os.listdir(path.dirname(dst)) if fn.endswith('.tmp')], [])
+
+    def test_duplicate_images(self):
+        """ 测试两个源目录中有同名的页面图时只复制第一个，不会有两个线程写同一临时文件 """
+        self.write('img/a/GL_1_1.jpg', b'a' * 50)
+        self.write('img/b/GL_1_1.jpg', b'b' * 60)
+        self.write('img/b/GL_1_2.jpg', b'c' * 70)
+        img_path = add_pages.IMG_PATH
+        add_pages.IMG_PATH = path.join(self.path, 'static')
+        try:
+            files = add_pages.scan_images(path.join(self.path, 'img'), {'GL_1_1', 'GL_1_2'}, [])
+            self.assertEqual(sorted(path.relpath(src, self.path) for src, _ in files),
+                             [path.join('img', 'a', 'GL_1_1.jpg'), path.join('img', 'b', 'GL_1_2.jpg')])
+            add_pages.copy_img_files(path.join(self.path, 'img'), {'GL_1_1', 'GL_1_2'}, workers=4)
+            with open(path.join(self.path, 'static', 'GL', 'GL_1_1.jpg'), 'rb') as f:
+                self.assertEqual(f.read(), b'a' * 50)
+            self.assertEqual(sorted(os.listdir(path.join(self.path, 'static', 'GL'))), ['GL_1_1.jpg', 'GL_1_2.jpg'])
+        finally:
+            add_pages.IMG_PATH = img_path
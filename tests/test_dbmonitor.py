@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/19
+"""
+from tests.testcase import APITestCase
+
+
+class TestDbMonitor(APITestCase):
+
+    def test_db_timing(self):
+        r = self.fetch('/api/pages/cut_start')
+        self.assertRegex(r.headers['Server-Timing'], r'^db;dur=[\d.]+;desc="[1-9]\d* commands"')
+        self.assertIn(b'dzj_db_command_duration_seconds_sum{handler="GetPagesApi"}', self.fetch('/metrics').body)
+        r = self.parse_response(self.fetch('/debug/queries'))
+        self.assertIn('items', r)
+        self.assertEqual(self.fetch('/debug/queries?count=x').code, 400)
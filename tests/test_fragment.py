@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/18
+"""
+from types import SimpleNamespace
+from unittest import TestCase
+from controller.base import BaseHandler
+from controller.fragment import FragmentCache, TemplateLoader, fragment_cache
+from controller.views.modules import CommonHead
+
+
+class FragmentHandler(object):
+    """ 只有 render_fragment 所需属性的响应对象，记下实际渲染的次数 """
+    render_fragment = BaseHandler.render_fragment
+
+    def __init__(self, user):
+        self.current_user = user
+        self.request = self.ui = self.locale = None
+        self.rendered = []
+
+    def render_string(self, template_name, **kwargs):
+        self.rendered.append(template_name)
+        return '<span>%s</span><!--user_name-->' % kwargs['authority']
+
+
+class TestFragment(TestCase):
+
+    def setUp(self):
+        fragment_cache.clear()
+
+    def test_lru(self):
+        """ 测试超出容量时淘汰最久未用的片段 """
+        cache = FragmentCache(max_size=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')  # a 成为最近使用的
+        cache.set('c', 'C')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+
+        cache.set('a', 'A2')  # 更新已有的键不增加条数
+        cache.set('d', 'D')
+        self.assertEqual(cache.get('a'), 'A2')
+        self.assertIsNone(cache.get('c'))
+
+    def test_reset_loader(self):
+        """ 测试重新加载模板时清空片段缓存 """
+        fragment_cache.set('a', 'A')
+        TemplateLoader('views').reset()
+        self.assertEqual(len(fragment_cache), 0)
+        self.assertIsNone(fragment_cache.get('a'))
+
+    def test_common_head(self):
+        """ 测试页头片段按权限缓存，同权限的用户共用一份，用户名在取出后填入并转义 """
+        h1 = FragmentHandler(SimpleNamespace(name='张三', authority='切分校对员'))
+        h2 = FragmentHandler(SimpleNamespace(name='<李四>', authority='切分校对员'))
+        h3 = FragmentHandler(SimpleNamespace(name='王五', authority='文字校对员'))
+
+        self.assertEqual(CommonHead(h1).render(), '<span>切分校对员</span>张三')
+        self.assertEqual(CommonHead(h2).render(), '<span>切分校对员</span>&lt;李四&gt;')
+        self.assertEqual(CommonHead(h3).render(), '<span>文字校对员</span>王五')
+        self.assertEqual((len(h1.rendered), len(h2.rendered), len(h3.rendered)), (1, 0, 1))
+        self.assertEqual(len(fragment_cache), 2)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/19
+"""
+from os import path
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+from controller.image import TileCache, build_pyramid, dir_size
+from tests.testcase import APITestCase
+
+img_file = path.join(path.dirname(__file__), 'data', 'GL', 'GL_1056_5_6.jpg')
+
+
+class TestTileCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def build(self, name, mtime):
+        out_path = path.join(self.path, name[:2], name)
+        build_pyramid(img_file, out_path, tile_size=512)
+        os.utime(path.join(out_path, 'image.dzi'), (mtime, mtime))
+        return out_path
+
+    def test_trim(self):
+        """ 测试超出容量时按页淘汰最久未打开的切片目录，打开过的页保留 """
+        now = time.time()
+        pages = [self.build('GL_1_%d' % i, now - 100 + i) for i in range(3)]
+        os.makedirs(path.join(self.path, 'GL', 'GL_1_9.1.2.tmp'))  # 正在生成的临时目录不计入
+        size = dir_size(pages[0])
+
+        cache = TileCache(self.path, size * 2.5)
+        self.assertEqual(cache.total, size * 3)
+        cache.touch(pages[0])  # 第一页最近打开过
+        cache.added(self.build('GL_1_3', now), size)
+        self.assertEqual(sorted(os.listdir(path.join(self.path, 'GL'))),
+                         ['GL_1_0', 'GL_1_3', 'GL_1_9.1.2.tmp'])
+        self.assertEqual(cache.total, size * 2)
+
+
+class TestImage(APITestCase):
+
+    def setUp(self):
+        super(TestImage, self).setUp()
+        # 页面图平时由 add_pages.py 复制到 static/img，缩略图和切片的测试用 tests/data 中的页面图
+        self.img_file = path.join(self._app.IMAGE_PATH, 'GL', 'GL_1056_5_6.jpg')
+        self.img_copied = not path.exists(self.img_file)
+        if self.img_copied:
+            if not path.exists(path.dirname(self.img_file)):
+                os.makedirs(path.dirname(self.img_file))
+            shutil.copy(img_file, self.img_file)
+
+    def tearDown(self):
+        if self.img_copied:
+            os.remove(self.img_file)
+        super(TestImage, self).tearDown()
+
+    def test_thumbnail(self):
+        r = self.fetch('/thumb/GL/GL_1056_5_6.jpg?w=120')
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'image/jpeg')
+        r = self.fetch('/thumb/GL/GL_1056_5_6.jpg?w=120', headers={'If-None-Match': r.headers['Etag']})
+        self.assertEqual(r.code, 304)
+        self.assertEqual(self.fetch('/thumb/GL/GL_1056_5_7.jpg?w=120').code, 404)
+
+    def test_tiles(self):
+        r = self.fetch('/tile/GL/GL_1056_5_6.dzi')
+        self.assertEqual(r.code, 200)
+        self.assertIn(b'TileSize="256"', r.body)
+        r = self.fetch('/tile/GL/GL_1056_5_6_files/0/0_0.jpg')
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.fetch('/tile/GL/GL_1056_5_6_files/0/9_9.jpg').code, 404)
+        self.assertEqual(self.fetch('/tile/GL/GL_1056_5_7.dzi').code, 404)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/19
+"""
+from os import path
+from types import SimpleNamespace
+from unittest import TestCase
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from controller.metrics import Metrics, RETIRED
+from tests.testcase import APITestCase
+
+
+class TimedHandler(object):
+    """ 只有耗时统计所需属性的响应对象 """
+
+    def __init__(self, status=200):
+        self.status = status
+        self.request = SimpleNamespace(method='GET')
+        self.db_count, self.db_time = 2, 0.01
+
+    def get_status(self):
+        return self.status
+
+
+class TestMetricsFiles(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def exited_worker(self, count):
+        """ 生成已退出的工作进程留下的数据文件 """
+        proc = subprocess.Popen([sys.executable, '-c', ''])
+        proc.wait()
+        metrics = Metrics(self.path)
+        for i in range(count):
+            metrics.observe(TimedHandler(), 0.02)
+        metrics.save()
+        with open(metrics.filename) as f:
+            data = json.load(f)
+        with open(metrics.filename, 'w') as f:
+            json.dump(dict(data, pid=proc.pid), f)
+
+    def count(self, metrics):
+        merged, db = metrics.collect()
+        return sum(merged[('TimedHandler', 'GET', 200)][:-1]), db['TimedHandler'][0]
+
+    def test_exited_workers(self):
+        """ 测试已退出的工作进程的计数并入 retired.json，滚动重启后计数不减少 """
+        metrics = Metrics(self.path)
+        metrics.observe(TimedHandler(), 0.02)
+        self.exited_worker(3)
+        self.assertEqual(self.count(metrics), (4, 8))
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(['.lock', RETIRED, path.basename(metrics.filename)]))
+        self.assertEqual(self.count(metrics), (4, 8))
+
+        self.exited_worker(2)
+        self.assertEqual(self.count(metrics), (6, 12))
+        self.assertEqual(len([fn for fn in os.listdir(self.path) if fn.endswith('.json')]), 2)
+
+
+class TestMetrics(APITestCase):
+
+    def test_metrics(self):
+        self.fetch('/api/pages/cut_start')
+        r = self.fetch('/metrics')
+        self.assertEqual(r.code, 200)
+        self.assertIn(b'dzj_http_request_duration_seconds_bucket{handler="GetPagesApi"', r.body)
+        config = dict(self._app.config)
+        self._app.config['metrics_allow'] = ['10.0.0.1']
+        try:  # 不信任转发的客户端地址
+            self.assertEqual(self.fetch('/metrics', headers={'X-Real-Ip': '10.0.0.1'}).code, 403)
+        finally:
+            self._app.config = config
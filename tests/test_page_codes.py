@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/18
+"""
+from os import path
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+from controller import page_codes
+
+
+class TestPageCodes(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.json_file = path.join(self.path, 'page_codes.json')
+        self.index_file = path.join(self.path, 'page_codes.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write_json(self, codes):
+        with open(self.json_file, 'w', encoding='utf-8') as f:
+            json.dump(codes, f, ensure_ascii=False)
+
+    def test_search(self):
+        """ 测试二分查找各页名，包括首尾、不存在的和非ASCII的页名 """
+        codes = {'GL_%d_%d' % (i, j): '%04x' % (i * 10 + j) for i in range(1, 40) for j in range(1, 4)}
+        codes['YB_1_1'] = '大藏'
+        self.write_json(codes)
+        self.assertEqual(page_codes.build(self.json_file), len(codes))
+
+        index = page_codes.PageCodeIndex(self.index_file)
+        try:
+            self.assertEqual(len(index), len(codes))
+            for name, code in codes.items():
+                self.assertEqual(index.get(name), code)
+            for name in ['', 'A', 'GL_1', 'GL_1_10', 'GL_39_4', 'ZZ']:
+                self.assertIsNone(index.get(name))
+            self.assertEqual(index.get('QL_1', '-'), '-')
+        finally:
+            index.close()
+
+    def test_empty(self):
+        """ 测试没有索引文件或没有页名时都查不到 """
+        index = page_codes.PageCodeIndex(self.index_file)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get('GL_1_1'))
+
+        self.write_json({})
+        index = page_codes.PageCodeIndex(self.index_file, self.json_file)
+        self.assertTrue(path.exists(self.index_file))
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get('GL_1_1'))
+
+    def test_reload(self):
+        """ 测试JSON文件较新时自动生成索引，索引文件被原子地替换后重新映射 """
+        self.write_json({'GL_1_1': 'a1', 'GL_1_2': 'a2'})
+        index = page_codes.PageCodeIndex(self.index_file, self.json_file)
+        try:
+            self.assertEqual(index.get('GL_1_2'), 'a2')
+            index.CHECK_INTERVAL = 0
+
+            time.sleep(0.01)  # 确保修改时间不同
+            self.write_json({'GL_1_1': 'b1', 'GL_1_3': 'b3', 'GL_1_4': 'b4'})
+            page_codes.build(self.json_file, self.index_file)
+            self.assertEqual([f for f in os.listdir(self.path) if f.endswith('.tmp')], [])
+            self.assertEqual(len(index), 3)
+            self.assertEqual(index.get('GL_1_1'), 'b1')
+            self.assertIsNone(index.get('GL_1_2'))
+            self.assertEqual(index.get('GL_1_4'), 'b4')
+
+            index.CHECK_INTERVAL = 3600  # 在检查间隔内不重新检查，已映射的内容在文件删除后仍可读
+            os.remove(self.index_file)
+            self.assertEqual(index.get('GL_1_3'), 'b3')
+            index.CHECK_INTERVAL = 0
+            self.assertIsNone(index.get('GL_1_3'))
+            self.assertEqual(len(index), 0)
+        finally:
+            index.close()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/16
+"""
+from datetime import datetime, timedelta
+from tornado.testing import gen_test
+from tests.testcase import APITestCase
+from controller import periodic
+import model.user as u
+
+
+class TestPeriodic(APITestCase):
+
+    @gen_test
+    def test_job_lease(self):
+        """ 测试定时任务在一个间隔内只执行一次，执行结果记在 job 表中 """
+        calls = []
+        periodic.job('test_job', 3600)(lambda app: calls.append(1) or len(calls))
+        try:
+            db = self._app.db
+            db.job.delete_one(dict(_id='test_job'))
+            scheduler = periodic.Scheduler(self._app)
+            j = periodic.jobs['test_job']
+
+            self.assertTrue((yield scheduler.run(j)))
+            self.assertFalse((yield scheduler.run(j)))
+            self.assertEqual(len(calls), 1)
+
+            r = db.job.find_one(dict(_id='test_job'))
+            self.assertEqual(r['last_status'], 'ok')
+            self.assertEqual(r['last_result'], 1)
+            self.assertEqual(r['runs'], 1)
+            self.assertLessEqual(r['lease_time'], r['end_time'])
+        finally:
+            periodic.jobs.pop('test_job', None)
+
+    def test_reclaim_locks(self):
+        """ 测试领取后超时未提交的任务被退回 """
+        db, name = self._app.db, 'TEST_reclaim'
+        db.page.delete_many(dict(name=name))
+        db.page.insert_one(dict(name=name, version=1,
+                                char_cut_proof_status=u.STATUS_LOCKED, char_cut_proof_user='u1',
+                                char_cut_proof_start_time=datetime.now() - timedelta(days=3),
+                                text_proof_1_status=u.STATUS_LOCKED, text_proof_1_user='u2',
+                                text_proof_1_start_time=datetime.now()))
+        try:
+            result = periodic.reclaim_locks(self._app)
+            self.assertGreaterEqual(result.get('char_cut_proof', 0), 1)
+            page = db.page.find_one(dict(name=name))
+            self.assertEqual(page['char_cut_proof_status'], u.STATUS_RETURNED)
+            self.assertNotIn('char_cut_proof_user', page)
+            self.assertEqual(page['text_proof_1_status'], u.STATUS_LOCKED)
+            self.assertEqual(page['version'], 2)
+            self.assertEqual(db.log.count_documents(dict(type='reclaim_char_cut_proof', context=name)), 1)
+
+            # 已退回的页面不再匹配，也不重复记日志
+            periodic.reclaim_locks(self._app)
+            self.assertEqual(db.page.find_one(dict(name=name))['version'], 2)
+            self.assertEqual(db.log.count_documents(dict(type='reclaim_char_cut_proof', context=name)), 1)
+        finally:
+            db.page.delete_many(dict(name=name))
+            db.log.delete_many(dict(context=name))
+
+    def test_rebuild_user_stats(self):
+        """ 测试由页面的任务状态重新统计各用户完成的任务数 """
+        db, name, user_id = self._app.db, 'TEST_stat', 'TEST_stat_user'
+        db.page.delete_many(dict(name=name))
+        db.page.insert_one(dict(name=name, char_cut_proof_status=u.STATUS_ENDED, char_cut_proof_user=user_id,
+                                block_cut_review_status=u.STATUS_ENDED, block_cut_review_user=user_id,
+                                text_proof_1_status=u.STATUS_LOCKED, text_proof_1_user=user_id))
+        db.user_stat.update_one({'_id': user_id}, {'$inc': {'text_proof_1': 1, 'text_proof_count': 1}}, upsert=True)
+        try:
+            self.assertGreaterEqual(periodic.rebuild_user_stats(self._app), 1)
+            r = db.user_stat.find_one({'_id': user_id})
+            self.assertEqual((r['char_cut_proof'], r['cut_proof_count'], r['cut_review_count']), (1, 1, 1))
+            self.assertEqual(r['text_proof_count'], 0)
+        finally:
+            db.page.delete_many(dict(name=name))
+            db.user_stat.delete_one({'_id': user_id})
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@time: 2019/3/19
+"""
+from tests.testcase import APITestCase
+from controller.base import BaseHandler
+import time
+
+
+class SleepHandler(BaseHandler):
+    """ 耗时的请求，用于测试采样分析 """
+
+    def get(self):
+        time.sleep(0.1)
+        self.send_response({})
+
+
+class TestProfiler(APITestCase):
+
+    def test_profiles(self):
+        self._app.add_handlers('.*$', [(r'/test/sleep', SleepHandler)])
+        profiler = self._app.profiler
+        sample, enabled = profiler.sample, profiler.enabled
+        profiler.sample, profiler.enabled = 1, True
+        try:
+            self.fetch('/test/sleep')
+            profiler.stop()  # 写出分析结果
+            r = self.parse_response(self.fetch('/debug/profiles'))
+            self.assertTrue(r['enabled'])
+            items = [p for p in r['items'] if p['handler'] == 'SleepHandler']
+            self.assertTrue(items)
+            self.assertGreater(items[0]['samples'], 0)
+            self.assertGreaterEqual(items[0]['ms'], 50)
+            r = self.fetch('/debug/profiles/' + items[0]['name'])
+            self.assertEqual(r.code, 200)
+            self.assertIn(b'tests/test_profiler.py:get:', r.body)  # 栈中有 SleepHandler.get
+            self.assertEqual(self.fetch('/debug/profiles?count=x').code, 400)
+        finally:
+            profiler.sample, profiler.enabled = sample, enabled
@@ -101,3 +101,13 @@ class TestUserApi(APITestCase):
         self.assert_code(200, r)
         r = self.fetch('/api/user/login', body={'data': dict(email='t2@test.com', password='t12345')})
         self.assert_code(e.no_user, r)
+
+    def test_users_data(self):
+        """ 测试数据管理页面在文档库中分页，无效的页码返回参数错误 """
+        self.add_admin_user()
+        self.login_as_admin()
+        r = self.parse_response(self.fetch('/dzj_user_data.html?_raw=1&order=-cut_proof_count&page_size=1&page=1'))
+        self.assertEqual(len(r['users']), 1)
+        self.assertGreaterEqual(r['page_count'], r['total'])
+        for bad in ['page=x', 'page_size=1.5']:
+            self.assert_code(e.invalid_parameter, self.fetch('/dzj_user_data.html?_raw=1&' + bad))
@@ -53,4 +53,4 @@ class TestViews(APITestCase):
         self.login('text1@test.com', 't12345')
         r = self.parse_response(self.fetch('/user/profile?_raw=1'))
         self.assertIn('user', r)
-        self.assertIn('name', r['user'])
\ No newline at end of file
+        self.assertIn('name', r['user'])
@@ -1,9 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# 处理网页模板中的静态文件引用
+# python views/static.py  合并各网页中重复的 _base_css.html 引用
+# python views/static.py build  将 _base_css.html、_base_js.html 引用的文件合并压缩为带内容哈希的文件，改为引用 _dist_*.html
+# python views/static.py build --restore  恢复引用 _base_*.html
+
 from glob import glob
 from os import path
+import hashlib
+import json
+import os
 import re
+import sys
 
 
 def sub_static_file(m):
@@ -65,5 +74,109 @@ def scan_dup_html(html_path, base_file):
                 f.write(lines)
 
 
-static_path = path.join(path.dirname(__file__), '..', 'static')
-scan_dup_html(path.dirname(__file__), '_base_css.html')
+def minify_css(text, css_file, out_path):
+    def rebase_url(m):
+        url = m.group(2)
+        if re.match(r'^(data:|https?:|/|#)', url):
+            return m.group()
+        rel_name = re.sub(r'[?#].*$', '', url)
+        target = path.normpath(path.join(path.dirname(css_file), rel_name))
+        return 'url(%s%s)' % (path.relpath(target, out_path).replace(os.sep, '/'), url[len(rel_name):])
+
+    text = re.sub(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)', rebase_url, text)
+    text = re.sub(r'@charset[^;]+;', '', text)
+    text = re.sub(r'/\*[\s\S]*?\*/', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def write_bundle(files, ext, out_path):
+    if ext == 'css':
+        text = '\n'.join(minify_css(open(path.join(static_path, f), encoding='utf-8').read(),
+                                    path.join(static_path, f), out_path) for f in files)
+    else:
+        # 脚本只合并不改写，多数已是 .min.js
+        text = '\n;\n'.join(open(path.join(static_path, f), encoding='utf-8').read().strip() for f in files)
+    text = text.encode('utf-8')
+    name = 'bundle.%s.%s' % (hashlib.md5(text).hexdigest()[:12], ext)
+    with open(path.join(out_path, name), 'wb') as f:
+        f.write(text)
+    return name
+
+
+def bundle_template(html_path, base_file, ext, out_path, manifest):
+    re_asset = {
+        'css': r'^\s*<link (?=[^>]*stylesheet)[^>]*static_url\([\'"]([^\'"]+\.css)[\'"]\)[^>]*>\s*$',
+        'js': r'^\s*<script [^>]*static_url\([\'"]([^\'"]+\.js)[\'"]\)[^>]*></script>\s*$'}[ext]
+    tags = {'css': '<link href="/static/dist/%s" rel="stylesheet" />',
+            'js': '<script src="/static/dist/%s"></script>'}
+    lines, files = [], []
+
+    def flush():
+        if files:
+            name = write_bundle(files, ext, out_path)
+            manifest[name] = list(files)
+            lines.append(tags[ext] % name)
+            del files[:]
+
+    with open(path.join(html_path, base_file)) as f:
+        for line in f.read().split('\n'):
+            m = re.match(re_asset, line)
+            if m and path.exists(path.join(static_path, m.group(1))):
+                files.append(m.group(1))
+            elif files and (not line.strip() or re.match(r'^\s*<!--.*-->\s*$', line)):
+                continue
+            else:
+                flush()
+                lines.append(line)
+    flush()
+
+    dist_file = base_file.replace('_base_', '_dist_')
+    with open(path.join(html_path, dist_file), 'w') as f:
+        f.write('\n'.join(lines))
+    return dist_file
+
+
+def replace_includes(html_path, old_file, new_file):
+    for fn in glob(path.join(html_path, '*.html')):
+        with open(fn) as f:
+            old = text = f.read()
+        text = text.replace('{%% include %s %%}' % old_file, '{%% include %s %%}' % new_file)
+        if text != old:
+            with open(fn, 'w') as f:
+                f.write(text)
+
+
+def build(restore=False):
+    html_path = path.dirname(path.abspath(__file__))
+    if restore:
+        for base_file in ['_base_css.html', '_base_js.html']:
+            replace_includes(html_path, base_file.replace('_base_', '_dist_'), base_file)
+        return
+
+    out_path = path.join(static_path, 'dist')
+    if not path.exists(out_path):
+        os.mkdir(out_path)
+    for fn in glob(path.join(out_path, 'bundle.*')):
+        os.remove(fn)
+
+    manifest = {}
+    for base_file, ext in [('_base_css.html', 'css'), ('_base_js.html', 'js')]:
+        dist_file = bundle_template(html_path, base_file, ext, out_path, manifest)
+        replace_includes(html_path, base_file, dist_file)
+    with open(path.join(out_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    for name, files in manifest.items():
+        print('%s: %d files, %d bytes' % (name, len(files), path.getsize(path.join(out_path, name))))
+
+
+static_path = path.abspath(path.join(path.dirname(__file__), '..', 'static'))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import fire
+
+        fire.Fire(dict(build=build, static=scan_files))
+    else:
+        scan_dup_html(path.dirname(__file__), '_base_css.html')